@@ -0,0 +1,101 @@
+## Native NumPy reader/writer for PLINK 1 binary (.bed) genotype files in SNP-major mode
+## Genotypes are decoded to int8 as 2 - (A1 allele count), the convention used by read_bed, with 3 marking missing
+
+import os.path
+
+import numpy as np
+
+BED_MAGIC = b'\x6c\x1b\x01'
+MISSING = 3
+
+# 2-bit PLINK codes -> FRAPOSA coding (00: hom A1, 01: missing, 10: het, 11: hom A2)
+CODE_VALUES = np.array([0, MISSING, 1, 2], dtype=np.int8)
+
+# Lookup table decoding one packed byte into its four genotypes, lowest bits first
+BYTE_VALUES = CODE_VALUES[(np.arange(256)[:, None] >> np.arange(0, 8, 2)) & 3]
+
+# FRAPOSA coding -> 2-bit PLINK codes
+VALUE_CODES = np.argsort(CODE_VALUES).astype(np.uint8)
+
+
+def encode(geno):
+    """Packs an int8 (variants x samples) matrix in FRAPOSA coding into .bed rows, zero-padding the last byte"""
+    b, n = geno.shape
+    codes = np.zeros((b, (n + 3) // 4 * 4), dtype=np.uint8)
+    codes[:, :n] = VALUE_CODES[geno]
+    codes = codes.reshape((b, -1, 4)) << np.arange(0, 8, 2, dtype=np.uint8)
+    return np.bitwise_or.reduce(codes, axis=2)
+
+
+def missing_row(n_samples):
+    """Packed .bed row with every genotype missing (2-bit code 01), zero-padded like encode()"""
+    row = np.full((n_samples + 3) // 4, 0b01010101, dtype=np.uint8)
+    if n_samples % 4:
+        row[-1] &= (1 << 2 * (n_samples % 4)) - 1
+    return row
+
+
+def count_lines(filename):
+    with open(filename, 'rb') as f:
+        return sum(1 for line in f if line.strip())
+
+
+class Bed:
+    """Memory-mapped view of a .bed file as a (variants x packed bytes) uint8 array"""
+
+    def __init__(self, bed_filepref, n_variants=None, n_samples=None):
+        if n_variants is None:
+            n_variants = count_lines(bed_filepref + '.bim')
+        if n_samples is None:
+            n_samples = count_lines(bed_filepref + '.fam')
+        self.filename = bed_filepref + '.bed'
+        self.n_variants = n_variants
+        self.n_samples = n_samples
+        self.n_bytes = (n_samples + 3) // 4
+        with open(self.filename, 'rb') as f:
+            if f.read(3) != BED_MAGIC:
+                raise ValueError('{} is not a SNP-major PLINK .bed file'.format(self.filename))
+        expected_size = len(BED_MAGIC) + n_variants * self.n_bytes
+        if os.path.getsize(self.filename) != expected_size:
+            raise ValueError('{} has {} bytes, expected {} for {} variants and {} samples'.format(
+                self.filename, os.path.getsize(self.filename), expected_size, n_variants, n_samples))
+        if n_variants == 0:
+            self.packed = np.zeros((0, self.n_bytes), dtype=np.uint8)
+        else:
+            self.packed = np.memmap(self.filename, dtype=np.uint8, mode='r', offset=len(BED_MAGIC),
+                                    shape=(n_variants, self.n_bytes))
+
+    def read(self, variant_idx=None, sample_idx=None):
+        """Decodes the selected variants (rows) and samples (columns) into an int8 matrix.
+        variant_idx may be a slice or an index array; sample_idx is an index array or None for all samples"""
+        if variant_idx is None:
+            variant_idx = slice(None)
+        packed = self.packed[variant_idx]
+        if sample_idx is None:
+            return BYTE_VALUES[packed].reshape((packed.shape[0], -1))[:, :self.n_samples]
+        sample_idx = np.asarray(sample_idx)
+        shift = (sample_idx & 3).astype(np.uint8) * 2
+        return CODE_VALUES[(packed[:, sample_idx >> 2] >> shift) & 3]
+
+    def iter_blocks(self, block_size=4096, variant_idx=None, sample_idx=None):
+        """Yields decoded blocks of at most block_size consecutive (or consecutively indexed) variants"""
+        n = self.n_variants if variant_idx is None else len(variant_idx)
+        for start in range(0, n, block_size):
+            if variant_idx is None:
+                rows = slice(start, min(start + block_size, n))
+            else:
+                rows = variant_idx[start:start + block_size]
+            yield self.read(rows, sample_idx)
+
+
+def create_bed(bed_filepref, n_variants, n_samples):
+    """Creates a .bed file of the given dimensions and returns its rows as a writable memory map"""
+    filename = bed_filepref + '.bed'
+    n_bytes = (n_samples + 3) // 4
+    with open(filename, 'wb') as f:
+        f.write(BED_MAGIC)
+        f.truncate(len(BED_MAGIC) + n_variants * n_bytes)
+    if n_variants == 0:
+        return np.zeros((0, n_bytes), dtype=np.uint8)
+    return np.memmap(filename, dtype=np.uint8, mode='r+', offset=len(BED_MAGIC), shape=(n_variants, n_bytes))
+
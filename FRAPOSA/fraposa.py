@@ -9,6 +9,7 @@ import pandas as pd
 from pyplink import PyPlink
 from sklearn.neighbors import KNeighborsClassifier
 
+from .bed import Bed
 from .variants import MatchType, Variants
 
 matplotlib.use('Agg')
@@ -16,12 +17,19 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 from matplotlib.lines import Line2D
 import os.path
+import hashlib
+import json
 import time
 from datetime import datetime
 import sys
 import logging
+from scipy.sparse.linalg import eigsh
 from sklearn.utils.extmath import randomized_svd
-from typing import Union
+from typing import Optional, Union
+from dataclasses import dataclass, field
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from threadpoolctl import threadpool_limits
 
 
 def create_logger(out_filepref='fraposa'):
@@ -41,8 +49,17 @@ def create_logger(out_filepref='fraposa'):
     return log
 
 
+def fix_signs(V):
+    ''' Flips each eigenvector (column of V) so that its largest-magnitude entry is positive, as eigensolvers
+    return them with arbitrary signs '''
+    signs = np.sign(V[np.argmax(np.abs(V), axis=0), np.arange(V.shape[1])])
+    signs[signs == 0] = 1
+    return V * signs
+
+
 def svd_eigcov(XTX):
     ssq, V = np.linalg.eigh(XTX)
+    V = fix_signs(V)
     V = np.squeeze(V)
     ssq = np.squeeze(ssq)
     s = np.sqrt(abs(ssq))
@@ -51,6 +68,21 @@ def svd_eigcov(XTX):
     return s, V
 
 
+def svd_eigcov_topk(XTX, k, tol=1e-10):
+    ''' Leading k values of svd_eigcov by Lanczos iteration (eigsh), logging the eigenpair residuals '''
+    n = XTX.shape[0]
+    if k >= n:
+        return svd_eigcov(XTX)
+    ssq, V = eigsh(XTX, k=k, which='LA', tol=tol)
+    order = np.argsort(ssq)[::-1]
+    ssq = ssq[order]
+    V = fix_signs(V[:, order])
+    residual = np.linalg.norm(XTX @ V - V * ssq, axis=0) / np.abs(ssq)
+    logging.info('Top-{} eigendecomposition (tol={}): max relative residual {:.3e}'.format(k, tol, residual.max()))
+    s = np.sqrt(abs(ssq))
+    return s, V
+
+
 def svd_online(U1, d1, V1, b, l=None):
     n, k = V1.shape
     if l is None:
@@ -60,22 +92,40 @@ def svd_online(U1, d1, V1, b, l=None):
     assert(l <= k)
     p = U1.shape[0]
     b = b.reshape((p,1)) # Make sure the new sample is a column vec
-    b_tilde = b - U1 @ (U1.T @ b)
-    b_tilde = b_tilde / np.sqrt(sum(np.square(b_tilde)))
-    R = np.concatenate((np.diag(d1), U1.transpose() @ b), axis = 1)
-    R_tail = np.concatenate((np.zeros((1,k)), b_tilde.transpose() @ b), axis = 1)
-    R = np.concatenate((R, R_tail), axis = 0)
-    d2, R_Vt = np.linalg.svd(R, full_matrices=False)[1:]
-    # TODO: Try using chomsky decomposition on R to speed up
-    # Since R is triangular
-    # Eigencomposition's runtime is the same as svd's
-    # d2, R_V = svd_eigcov(R.T @ R)
-    # R_Vt = R_V.T
-    V_new = np.zeros((k+1, n+1))
-    V_new[:k, :n] = V1.transpose()
-    V_new[k, n] = 1
-    V2 = (R_Vt @ V_new).transpose()[:,:l]
-    return d2, V2
+    # R = [[diag(d1), U1.T @ b], [0, |b - U1 @ U1.T @ b|]] is an arrowhead plus one row.
+    # As U1 is orthonormal, the norm of the residual follows from |b| and |U1.T @ b| without forming it.
+    UTb = (U1.T @ b).ravel()
+    R = np.zeros((k+1, k+1))
+    R[np.arange(k), np.arange(k)] = d1
+    R[:k, k] = UTb
+    R[k, k] = np.sqrt(max(np.sum(np.square(b)) - np.sum(np.square(UTb)), 0))
+    d2, R_Vt = np.linalg.svd(R)[1:]
+    # V2 = ([[V1, 0], [0, 1]] @ R_Vt.T)[:, :l], without materializing the padded V1
+    V2 = np.empty((n+1, l))
+    V2[:n, :] = V1 @ R_Vt[:l, :k].T
+    V2[n, :] = R_Vt[:l, k]
+    return d2[:l], V2
+
+
+def svd_online_block(U1, d1, V1, B, l=None):
+    ''' svd_online for a block of new samples (columns of B), each augmenting the reference separately '''
+    n, k = V1.shape
+    if l is None:
+        l = k
+    assert U1.shape[1] == k
+    assert len(d1) == k
+    assert(l <= k)
+    m = B.shape[1]
+    UTB = U1.T @ B
+    R = np.zeros((m, k+1, k+1))
+    R[:, np.arange(k), np.arange(k)] = d1
+    R[:, :k, k] = UTB.T
+    R[:, k, k] = np.sqrt(np.maximum(np.sum(np.square(B), axis=0) - np.sum(np.square(UTB), axis=0), 0))
+    d2, R_Vt = np.linalg.svd(R)[1:]
+    V2 = np.empty((m, n+1, l))
+    V2[:, :n, :] = np.einsum('ij,mlj->mil', V1, R_Vt[:, :l, :k])
+    V2[:, n, :] = R_Vt[:, :l, k]
+    return d2[:, :l], V2
 
 
 def procrustes(Y_mat, X_mat, return_transformed=False):
@@ -131,44 +181,132 @@ def procrustes_diffdim(Y_mat, X_mat, n_iter_max=10000, epsilon_min=1e-6, return_
             return R, rho, c
 
 
+def procrustes_diffdim_block(Y_mat, X_mat, n_iter_max=10000, epsilon_min=1e-6, Y_mean=None, Z_init=None):
+    ''' procrustes_diffdim from a stack of X (m x n x p_X) to a single Y, iterating each until it converges.
+    If Y_mean is given, Y_mat is taken as already centered. Z_init (n x (p_X - p_Y)) warm-starts the extra
+    dimensions of the target. Also returns the final Z, the number of iterations and last epsilon of each X '''
+    X = np.asarray(X_mat, dtype=np.double)
+    Y = np.asarray(Y_mat, dtype=np.double)
+    m, n_X, p_X = X.shape
+    n_Y, p_Y = Y.shape
+    assert n_X == n_Y
+    assert p_X >= p_Y
+    X_mean = np.mean(X, 1, keepdims=True)
+    X = X - X_mean
+    trXX = np.sum(X**2, axis=(1, 2))
+    if Y_mean is None:
+        Y_mean = np.mean(Y, 0)
+        Y = Y - Y_mean
+    # The reference half of Y.T @ X does not change between iterations
+    YTX = np.einsum('ni,mnj->mij', Y, X)
+    R = np.empty((m, p_X, p_X))
+    rho = np.empty(m)
+    c = np.empty((m, 1, p_X))
+    n_iter = np.full(m, n_iter_max)
+    epsilon = np.zeros(m)
+    active = np.arange(m)
+    if Z_init is None:
+        Z = np.zeros((m, n_X, p_X - p_Y))
+    else:
+        Z = np.repeat(Z_init[None, :, :], m, axis=0)
+    Z_out = Z.copy()
+    for i in range(n_iter_max):
+        Z_mean = np.mean(Z, 1, keepdims=True)
+        C = np.concatenate((YTX[active], np.swapaxes(Z - Z_mean, 1, 2) @ X[active]), axis=1)
+        U_C, s_C, VT_C = np.linalg.svd(C, full_matrices=False)
+        R[active] = np.swapaxes(VT_C, 1, 2) @ np.swapaxes(U_C, 1, 2)
+        rho[active] = np.sum(s_C, 1) / trXX[active]
+        W_mean = np.concatenate((np.broadcast_to(Y_mean, (len(active), 1, p_Y)), Z_mean), axis=2)
+        c[active] = W_mean - rho[active, None, None] * X_mean[active] @ R[active]
+        if p_X == p_Y:
+            n_iter[:] = 1
+            break
+        Z_new = (X[active] + X_mean[active]) @ R[active][:, :, p_Y:] * rho[active, None, None] + c[active][:, :, p_Y:]
+        Z_new_centered = Z_new - np.mean(Z_new, 1, keepdims=True)
+        epsilon[active] = np.sum((Z_new - Z)**2, axis=(1, 2)) / np.sum(Z_new_centered**2, axis=(1, 2))
+        Z_out[active] = Z_new
+        converged = epsilon[active] < epsilon_min
+        n_iter[active[converged]] = i + 1
+        active = active[~converged]
+        Z = Z_new[~converged]
+        if len(active) == 0:
+            break
+    return R, rho, c, Z_out, n_iter, epsilon
+
+
+@dataclass
+class ProcrustesState:
+    """
+    The reference side of the OADP Procrustes step, centered once per run, plus the warm start and the
+    convergence statistics carried from one study sample (or block of samples) to the next.
+    """
+    Y: np.ndarray # centered reference PCs
+    Y_mean: np.ndarray
+    n_iter_max: int = 10000
+    epsilon_min: float = 1e-6
+    # Off by default: a warm start makes each result depend on the samples before it, and so on sample order,
+    # block size and the number of workers
+    warm_start: bool = False
+    # Z: extra dimensions of the last solved target, used as the starting point for the next sample
+    Z: Optional[np.ndarray] = None
+    n_iter: list[int] = field(default_factory=list)
+    epsilon: list[float] = field(default_factory=list)
+
+    @classmethod
+    def from_pcs_ref(cls, pcs_ref, **kwargs):
+        Y_mean = np.mean(pcs_ref, 0)
+        return cls(Y=pcs_ref - Y_mean, Y_mean=Y_mean, **kwargs)
+
+    def update(self, Z, n_iter, epsilon):
+        self.n_iter.extend(n_iter.tolist())
+        self.epsilon.extend(epsilon.tolist())
+        if self.warm_start:
+            self.Z = Z[-1]
+
+    def summary(self):
+        n_iter = np.array(self.n_iter)
+        epsilon = np.array(self.epsilon)
+        n_converged = np.sum(epsilon < self.epsilon_min)
+        return ('Procrustes iterations per study sample: mean {:.1f}, max {}; {} / {} samples converged '
+                '(epsilon < {}, max epsilon {:.3e})').format(n_iter.mean(), n_iter.max(), n_converged, len(n_iter),
+                                                             self.epsilon_min, epsilon.max())
+
+
 def read_bed(bed_filepref, dtype=np.int8, filt_iid=None):
-    pyp = PyPlink(bed_filepref)
-    bim = pyp.get_bim()
-    fam = pyp.get_fam()
-    p = len(bim)
-    n = len(fam)
+    bim, fam = read_bim_fam(bed_filepref)
+    bed = Bed(bed_filepref, n_variants=len(bim), n_samples=len(fam))
+    i_extract = None # idx of samples to extract from genotype matrix
 
     if filt_iid:
-        fam_ids = list(zip(fam['fid'], fam['iid'])) # create tuples of ids from genotyping files
-        fam_mask = [x in filt_iid for x in fam_ids] # T/F overlap of genotype data and filter IDs (tuples)
-        n_matched = sum(fam_mask)
+        fam_ids = pd.MultiIndex.from_arrays([fam['fid'], fam['iid']]) # ids from genotyping files
+        fam_mask = fam_ids.isin(list(filt_iid)) # T/F overlap of genotype data and filter IDs (tuples)
+        n_matched = fam_mask.sum()
         if n_matched == 0:
             raise ValueError(f"ERROR: 0 / {len(filt_iid)} ids in filter list match the study dataset")
-        elif len(set(fam_ids)) != len(fam):
+        elif fam_ids.has_duplicates:
             raise ValueError("Samples with duplicated FID + IID detected, please remove and retry")
 
-        bed = np.zeros(shape=(p, n_matched), dtype=dtype)
-        i_extract = [i for i,x in enumerate(fam_mask) if x is True] # idx to extract from genotype matrix
-        for (i, (snp, genotypes)) in enumerate(pyp):
-            bed[i,:] = genotypes[i_extract]
+        i_extract = np.flatnonzero(fam_mask)
         fam = fam.loc[fam_mask,:]
         if n_matched < len(filt_iid):
             logging.warning('Warning: only {} / {} ids in filter list match the study dataset'.format(n_matched,
                                                                                                       len(filt_iid)))
         else:
             logging.info('Extracted {} samples from study genotyping data'.format(n_matched))
-    else:
-        bed = np.zeros(shape=(p, n), dtype=dtype)
-        for (i, (snp, genotypes)) in enumerate(pyp):
-            bed[i,:] = genotypes
+    return bed.read(sample_idx=i_extract).astype(dtype, copy=False), bim, fam
+
+
+def iter_bed_blocks(bed_filepref, block_size=4096, dtype=np.int8):
+    ''' Yields consecutive blocks of at most block_size variants (rows), coded like read_bed '''
+    for block in Bed(bed_filepref).iter_blocks(block_size):
+        yield block.astype(dtype, copy=False)
+
+
+def read_bim_fam(bed_filepref):
+    pyp = PyPlink(bed_filepref)
+    bim, fam = pyp.get_bim(), pyp.get_fam()
     pyp.close()
-    # for i in range(p):
-    #     for j in range(n):
-    #         bed[i,j] = 2 - bed[i,j]
-    # bed = 2 - bed
-    bed *= -1
-    bed += 2
-    return bed, bim, fam
+    return bim, fam
 
 
 def bim_varlist(bim):
@@ -233,8 +371,11 @@ def check_varlist(ref_vl: list[str], stu_vl: list[str]) -> MatchType:
 
 
 def save_vars_bim(bim, loc_output):
-    with open(loc_output, 'w') as outf:
+    # Written under a temporary name and renamed, so runs sharing the reference never read a partial file
+    tmp_path = '{}.{}.tmp'.format(loc_output, os.getpid())
+    with open(tmp_path, 'w') as outf:
         outf.write('\n'.join(bim_varlist(bim)))
+    os.replace(tmp_path, loc_output)
 
 
 def standardize(X, mean=None, std=None, miss=3):
@@ -242,13 +383,7 @@ def standardize(X, mean=None, std=None, miss=3):
     p, n = X.shape
     is_miss = X == miss
     if (mean is None) or (std is None):
-        mean = np.zeros(p)
-        std = np.zeros(p)
-        for i in range(p):
-            row_nomiss = X[i,:][~is_miss[i,:]]
-            mean[i] = np.mean(row_nomiss)
-            std[i] = np.std(row_nomiss)
-        std[std == 0] = 1
+        mean, std = masked_mean_std(X, is_miss)
     mean = mean.reshape((-1, 1))
     std = std.reshape((-1, 1))
     X -= mean
@@ -257,6 +392,23 @@ def standardize(X, mean=None, std=None, miss=3):
     return mean, std
 
 
+def masked_mean_std(X, is_miss, chunk_size=4096):
+    ''' Row means and SDs over the non-missing entries, vectorized over chunks of rows '''
+    p, n = X.shape
+    mean = np.zeros(p)
+    std = np.zeros(p)
+    for start in range(0, p, chunk_size):
+        rows = slice(start, start + chunk_size)
+        nomiss = ~is_miss[rows]
+        n_nomiss = np.sum(nomiss, axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean[rows] = np.sum(X[rows], axis=1, where=nomiss, dtype=np.float64) / n_nomiss
+            dev = X[rows] - mean[rows, None]
+            std[rows] = np.sqrt(np.sum(dev * dev, axis=1, where=nomiss, dtype=np.float64) / n_nomiss)
+    std[std == 0] = 1
+    return mean, std
+
+
 def eig_ref(X):
     print('Calculating reference covariance matrix...')
     XTX = X.T @ X
@@ -265,7 +417,40 @@ def eig_ref(X):
     return s, V, XTX
 
 
-def ref_aug_procrustes(pcs_ref, pcs_aug):
+def eig_ref_streamed(ref_filepref, block_size=4096, dim=None, tol=1e-10):
+    ''' eig_ref without loading the reference: standardizes blocks of variants and accumulates XTX block by block.
+    If dim is given only the leading dim components are computed, by svd_eigcov_topk '''
+    print('Calculating reference covariance matrix...')
+    X_mean, X_std = [], []
+    XTX = 0
+    for X in iter_bed_blocks(ref_filepref, block_size, dtype=np.float32):
+        mean, std = standardize(X)
+        X_mean.append(mean)
+        X_std.append(std)
+        XTX = XTX + (X.T @ X).astype(np.float64)
+    print('Eigendecomposition on reference covariance matrix...')
+    if dim is None:
+        s, V = svd_eigcov(XTX)
+    else:
+        s, V = svd_eigcov_topk(XTX, dim, tol)
+    return np.vstack(X_mean), np.vstack(X_std), s, V, XTX
+
+
+def project_ref_streamed(ref_filepref, X_mean, X_std, V, block_size=4096):
+    ''' Computes X @ V for the standardized reference genotypes, one block of variants at a time '''
+    U = []
+    start = 0
+    for X in iter_bed_blocks(ref_filepref, block_size, dtype=np.float32):
+        stop = start + X.shape[0]
+        standardize(X, X_mean[start:stop], X_std[start:stop])
+        U.append(X @ V)
+        start = stop
+    return np.vstack(U)
+
+
+def ref_aug_procrustes(pcs_ref, pcs_aug, state=None):
+    if state is not None:
+        return ref_aug_procrustes_block(pcs_ref, pcs_aug[None, :, :], state)[0]
     n_ref, p_ref = pcs_ref.shape
     n_aug, p_aug = pcs_aug.shape
     assert n_aug == n_ref + 1
@@ -277,19 +462,47 @@ def ref_aug_procrustes(pcs_ref, pcs_aug):
     return pcs_aug_tail_trsfed.flatten()
 
 
-def oadp(U, s, V, b, dim_ref=4, dim_stu=None, dim_online=None):
+def ref_aug_procrustes_block(pcs_ref, pcs_aug, state=None):
+    n_ref, p_ref = pcs_ref.shape
+    m, n_aug, p_aug = pcs_aug.shape
+    assert n_aug == n_ref + 1
+    assert p_aug >= p_ref
+    if state is None:
+        state = ProcrustesState.from_pcs_ref(pcs_ref, warm_start=False)
+    pcs_aug_head = pcs_aug[:, :-1, :]
+    pcs_aug_tail = pcs_aug[:, -1:, :]
+    R, rho, c, Z, n_iter, epsilon = procrustes_diffdim_block(state.Y, pcs_aug_head, state.n_iter_max, state.epsilon_min,
+                                                             Y_mean=state.Y_mean, Z_init=state.Z)
+    state.update(Z, n_iter, epsilon)
+    pcs_aug_tail_trsfed = pcs_aug_tail @ R * rho[:, None, None] + c
+    return pcs_aug_tail_trsfed.reshape((m, -1))
+
+
+def oadp(U, s, V, b, dim_ref=4, dim_stu=None, dim_online=None, state=None):
     if dim_stu is None:
         dim_stu = dim_ref * 2
     if dim_online is None:
         dim_online = dim_stu * 2
     pcs_ref = V[:, :dim_ref] * s[:dim_ref]
-    s_aug, V_aug = svd_online(U[:,:dim_online], s[:dim_online], V[:,:dim_online], b)
-    s_aug, V_aug = s_aug[:dim_stu], V_aug[:, :dim_stu]
+    s_aug, V_aug = svd_online(U[:,:dim_online], s[:dim_online], V[:,:dim_online], b, l=dim_stu)
     pcs_aug = V_aug * s_aug
-    pcs_stu = ref_aug_procrustes(pcs_ref, pcs_aug)
+    pcs_stu = ref_aug_procrustes(pcs_ref, pcs_aug, state)
     return pcs_stu[:dim_ref]
 
 
+def oadp_block(U, s, V, B, dim_ref=4, dim_stu=None, dim_online=None, state=None):
+    ''' oadp for every column of B at once; returns one row of PC scores per column '''
+    if dim_stu is None:
+        dim_stu = dim_ref * 2
+    if dim_online is None:
+        dim_online = dim_stu * 2
+    pcs_ref = V[:, :dim_ref] * s[:dim_ref]
+    s_aug, V_aug = svd_online_block(U[:,:dim_online], s[:dim_online], V[:,:dim_online], B, l=dim_stu)
+    pcs_aug = V_aug * s_aug[:, None, :]
+    pcs_stu = ref_aug_procrustes_block(pcs_ref, pcs_aug, state)
+    return pcs_stu[:, :dim_ref]
+
+
 def adp(XTX, X, w, pcs_ref, dim_stu=None):
     dim_ref = pcs_ref.shape[1]
     if dim_stu is None:
@@ -308,13 +521,16 @@ def adp(XTX, X, w, pcs_ref, dim_stu=None):
 
 def pca_stu(W, X_mean, X_std, method,
             U=None, s=None, V=None, XTX=None, X=None, pcs_ref=None,
-            dim_ref=None, dim_stu=None, dim_online=None):
+            dim_ref=None, dim_stu=None, dim_online=None, block_size=1,
+            procrustes_iter_max=None, procrustes_warm_start=False, check_budget=True):
     p_ref = len(X_mean)
     p_stu, n_stu = W.shape
     pcs_stu = np.zeros((n_stu, dim_ref))
 
     if method == 'oadp':
         assert all([a is not None for a in [U, s, V, dim_ref, dim_stu, dim_online]])
+        state = ProcrustesState.from_pcs_ref(V[:, :dim_ref] * s[:dim_ref], warm_start=procrustes_warm_start,
+                                             n_iter_max=procrustes_iter_max or 10000)
     if method == 'ap':
         assert all([a is not None for a in [U, dim_ref]])
     if method == 'sp':
@@ -322,26 +538,123 @@ def pca_stu(W, X_mean, X_std, method,
     if method == 'adp':
         assert all([a is not None for a in [XTX, X, pcs_ref, dim_ref, dim_stu]])
 
-    reporting_chunk = (n_stu // 10)
-    if reporting_chunk == 0:
-        reporting_chunk = 1
-
-    for i in range(n_stu):
-        w = W[:,i].astype(np.float64).reshape((-1,1))
-        standardize(w, X_mean, X_std, miss=3)
-        if method == 'oadp':
-            pcs_stu[i,:] = oadp(U, s, V, w, dim_ref, dim_stu, dim_online)
-        if method =='sp' or method == 'ap':
-            pcs_stu[i,:] = w.T @ U[:,:dim_ref]
-        if method =='adp':
-            pcs_stu[i,:] = adp(XTX, X, w, pcs_ref, dim_stu=dim_stu)
-        if (i+1) % reporting_chunk == 0:
-            logging.info('Finished {} out of {} study samples.'.format(i+1, n_stu))
+    if method == 'oadp' and block_size > 1:
+        # Standardize and project block_size samples per call, sharing the reference-only work
+        for start in range(0, n_stu, block_size):
+            stop = min(start + block_size, n_stu)
+            B = W[:, start:stop].astype(np.float64)
+            standardize(B, X_mean, X_std, miss=3)
+            pcs_stu[start:stop, :] = oadp_block(U, s, V, B, dim_ref, dim_stu, dim_online, state)
+            logging.info('Finished {} out of {} study samples.'.format(stop, n_stu))
+    else:
+        reporting_chunk = (n_stu // 10)
+        if reporting_chunk == 0:
+            reporting_chunk = 1
+
+        for i in range(n_stu):
+            w = W[:,i].astype(np.float64).reshape((-1,1))
+            standardize(w, X_mean, X_std, miss=3)
+            if method == 'oadp':
+                pcs_stu[i,:] = oadp(U, s, V, w, dim_ref, dim_stu, dim_online, state)
+            if method =='sp' or method == 'ap':
+                pcs_stu[i,:] = w.T @ U[:,:dim_ref]
+            if method =='adp':
+                pcs_stu[i,:] = adp(XTX, X, w, pcs_ref, dim_stu=dim_stu)
+            if (i+1) % reporting_chunk == 0:
+                logging.info('Finished {} out of {} study samples.'.format(i+1, n_stu))
+
+    if method == 'oadp':
+        logging.info(state.summary())
+        if check_budget:
+            check_procrustes_budget(W, X_mean, X_std, U, s, V, dim_ref, dim_stu, dim_online, pcs_stu, procrustes_iter_max)
 
     del W
     return pcs_stu
 
 
+def check_procrustes_budget(W, X_mean, X_std, U, s, V, dim_ref, dim_stu, dim_online, pcs_stu, procrustes_iter_max,
+                            n_check=64):
+    ''' Measures what a Procrustes iteration budget costs against fully converged, cold-started alignments
+    of the first n_check study samples '''
+    if procrustes_iter_max is None:
+        return
+    n_check = min(W.shape[1], n_check)
+    B = W[:, :n_check].astype(np.float64)
+    standardize(B, X_mean, X_std, miss=3)
+    pcs_check = oadp_block(U, s, V, B, dim_ref, dim_stu, dim_online)
+    logging.info('Procrustes budget of {} iterations: max abs PC difference from converged result '
+                 'on {} study samples is {:.3e}'.format(procrustes_iter_max, n_check,
+                                                        np.abs(pcs_check - pcs_stu[:n_check]).max()))
+
+
+# Arrays attached from shared memory in each pca_stu_parallel worker
+_shared_arrays = {}
+_shared_handles = []
+
+
+def _to_shared(arrays):
+    ''' Copies arrays into shared memory once; returns the blocks and a picklable (name, shape, dtype) spec '''
+    shms, specs = [], {}
+    for key, a in arrays.items():
+        a = np.ascontiguousarray(a)
+        shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+        np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[...] = a
+        shms.append(shm)
+        specs[key] = (shm.name, a.shape, a.dtype.str)
+    return shms, specs
+
+
+def _attach_shared(specs):
+    logging.getLogger().setLevel(logging.WARNING) # Progress is reported by the parent process
+    threadpool_limits(limits=1) # One BLAS thread per worker process
+    for key, (name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        _shared_handles.append(shm)
+        _shared_arrays[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _pca_stu_worker(start, stop, method, kwargs):
+    arrays = dict(_shared_arrays)
+    W = arrays.pop('W')[:, start:stop]
+    X_mean = arrays.pop('X_mean')
+    X_std = arrays.pop('X_std')
+    # The budget check runs once in the parent, whose log the workers do not write to
+    return start, pca_stu(W, X_mean, X_std, method, **arrays, **kwargs, check_budget=False)
+
+
+def pca_stu_parallel(W, X_mean, X_std, method, n_workers, **kwargs):
+    ''' Runs pca_stu over contiguous chunks of study samples in n_workers processes.
+    The study genotypes and the reference factors are placed in shared memory once rather than pickled per task. '''
+    p_stu, n_stu = W.shape
+    dim_ref = kwargs['dim_ref']
+    arrays = {k: v for k, v in kwargs.items() if isinstance(v, np.ndarray)}
+    kwargs = {k: v for k, v in kwargs.items() if k not in arrays}
+    arrays.update({'W': W, 'X_mean': X_mean, 'X_std': X_std})
+    n_chunks = min(n_stu, n_workers * 4)
+    bounds = np.linspace(0, n_stu, n_chunks + 1).astype(int)
+
+    pcs_stu = np.zeros((n_stu, dim_ref))
+    shms, specs = _to_shared(arrays)
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_attach_shared, initargs=(specs,)) as pool:
+            futures = [pool.submit(_pca_stu_worker, start, stop, method, kwargs)
+                       for start, stop in zip(bounds[:-1], bounds[1:])]
+            n_done = 0
+            for future in as_completed(futures):
+                start, pcs_chunk = future.result()
+                pcs_stu[start:start + len(pcs_chunk), :] = pcs_chunk # Gathered in .fam order
+                n_done += len(pcs_chunk)
+                logging.info('Finished {} out of {} study samples.'.format(n_done, n_stu))
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    if method == 'oadp':
+        check_procrustes_budget(W, X_mean, X_std, arrays['U'], arrays['s'], arrays['V'], dim_ref, kwargs['dim_stu'],
+                                kwargs['dim_online'], pcs_stu, kwargs.get('procrustes_iter_max'))
+    return pcs_stu
+
+
 def _write_pcs(df_pcs, df_fam, colnames, filepref, output_fmt, stage='REFERENCE'):
     pcs_ref = pd.DataFrame(data=df_pcs, index=df_fam[["fid", "iid"]], columns=colnames)
     pcs_ref.index = pd.MultiIndex.from_tuples(pcs_ref.index, names=['FID', 'IID'])
@@ -352,7 +665,9 @@ def _write_pcs(df_pcs, df_fam, colnames, filepref, output_fmt, stage='REFERENCE'
         # column is present but missing data
         pcs_ref["FID"] = pcs_ref["IID"]
 
-    pcs_ref.to_csv(filepref + '.pcs', sep='\t', header=True, index=False, float_format=output_fmt)
+    tmp_path = '{}.pcs.{}.tmp'.format(filepref, os.getpid())
+    pcs_ref.to_csv(tmp_path, sep='\t', header=True, index=False, float_format=output_fmt)
+    os.replace(tmp_path, filepref + '.pcs')
     logging.info('{} PC scores saved to {}.pcs'.format(stage, filepref))
 
 
@@ -369,11 +684,64 @@ def _load_mnsd(ref_filepref):
     return X_mean, X_std
 
 
+REF_CACHE_VERSION = 1
+
+
+def _ref_cache_key(ref_filepref, **params):
+    """Hash of the reference .bim/.bed contents, the cache format version and the PCA parameters"""
+    h = hashlib.sha256()
+    for suff in ['.bim', '.bed']:
+        with open(ref_filepref + suff, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    h.update(json.dumps({'version': REF_CACHE_VERSION, **params}, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def _load_ref_cache(ref_filepref, key):
+    """Memory-maps the saved reference PCA arrays, or returns None if they are missing or were built from other inputs"""
+    cache_dir = ref_filepref + '_pca_cache'
+    logging.info('Attemping to load saved reference PCA result...')
+    try:
+        with open(os.path.join(cache_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != REF_CACHE_VERSION or meta['key'] != key:
+            logging.info('Saved REFERENCE PCA result does not match the reference data or parameters, rebuilding.')
+            return None
+        cache = {name: np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r') for name in meta['arrays']}
+    except (OSError, ValueError, KeyError):
+        logging.info('REFERENCE PCA result is either nonexistent or incomplete.')
+        return None
+    logging.info('Reference PCA result successfully loaded.')
+    return cache
+
+
+def _save_ref_cache(ref_filepref, key, **arrays):
+    """Saves reference PCA arrays as .npy files under <ref_filepref>_pca_cache, writing meta.json last"""
+    cache_dir = ref_filepref + '_pca_cache'
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    os.makedirs(cache_dir, exist_ok=True)
+    if os.path.exists(meta_path):
+        os.remove(meta_path) # Invalidate before overwriting any arrays
+    for name, a in arrays.items():
+        tmp_path = os.path.join(cache_dir, '{}.{}.tmp.npy'.format(name, os.getpid()))
+        np.save(tmp_path, np.asarray(a))
+        os.replace(tmp_path, os.path.join(cache_dir, name + '.npy'))
+    tmp_path = '{}.{}.tmp'.format(meta_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': REF_CACHE_VERSION, 'key': key, 'arrays': list(arrays)}, f)
+    os.replace(tmp_path, meta_path)
+    logging.info('REFERENCE PCA result saved to {}'.format(cache_dir))
+
+
 def pca(ref_filepref, stu_filepref=None, stu_filt_iid=None, out_filepref=None, method='oadp',
-        dim_ref=4, dim_stu=None, dim_online=None, dim_rand=None, dim_spikes=None, dim_spikes_max=None):
+        dim_ref=4, dim_stu=None, dim_online=None, dim_rand=None, dim_spikes=None, dim_spikes_max=None,
+        block_size=256, n_workers=1, ref_block_size=4096, eig_method='dense', eig_tol=1e-10,
+        procrustes_iter_max=None, procrustes_warm_start=False):
 
     create_logger(out_filepref)
     assert method in ['randoadp', 'oadp', 'ap', 'adp', 'sp']
+    assert eig_method in ['dense', 'topk']
     if method in ['oadp', 'adp']:
         if dim_stu is None:
             dim_stu = dim_ref * 2
@@ -395,11 +763,17 @@ def pca(ref_filepref, stu_filepref=None, stu_filt_iid=None, out_filepref=None, m
     logging.info('Output prefix: {}'.format(out_filepref))
     logging.info('Method: {}'.format(method))
     logging.info('Reference dimension: {}'.format(dim_ref))
+    logging.info('Worker processes: {}'.format(n_workers))
+    if method in ['oadp', 'sp']:
+        logging.info('Reference eigendecomposition: {}'.format(eig_method))
     colnames_pcs = ['PC{}'.format(x + 1) for x in range(dim_ref)]
     if method in ['oadp', 'adp']:
         logging.info('Study dimension: {}'.format(dim_stu))
     if method == 'oadp':
         logging.info('Online SVD dimension: {}'.format(dim_online))
+        logging.info('Study block size: {}'.format(block_size))
+        logging.info('Procrustes iteration limit: {}, warm start: {}'.format(procrustes_iter_max or 10000,
+                                                                           procrustes_warm_start))
     if method == 'ap':
         # if dim_spikes is None:
         #     logging.info('Number of distant spikes (max={}) will be estimated by HDPCA.'.format(dim_spikes_max))
@@ -412,35 +786,36 @@ def pca(ref_filepref, stu_filepref=None, stu_filt_iid=None, out_filepref=None, m
 
     logging.info(datetime.now())
     if method in ['oadp', 'randoadp']:
-        try:
-            logging.info('Attemping to load saved reference PCA result...')
-            X_mean, X_std = _load_mnsd(ref_filepref)
-            s = np.loadtxt(ref_filepref+'_s.dat')
-            U = np.loadtxt(ref_filepref+'_U.dat')[:, :dim_online]
-            V = np.loadtxt(ref_filepref+'_V.dat')[:, :dim_online]
-            pcs_ref = _load_pcs_ref(ref_filepref)[:, :dim_ref]
-            logging.info('Warning: If you have changed the parameter settings, please delete '
-                         + ref_filepref + '_*.dat and ' + ref_filepref + '.pcs then rerun FRAPOSA.')
-            logging.info('Reference PCA result successfully loaded.')
-        except OSError:
-            logging.info('REFERENCE PCA result is either nonexistent or incomplete.')
+        cache_key = _ref_cache_key(ref_filepref, method=method, dim_ref=dim_ref, dim_online=dim_online,
+                                   dim_rand=dim_rand if method == 'randoadp' else None,
+                                   eig_method=eig_method if method == 'oadp' else None,
+                                   eig_tol=eig_tol if method == 'oadp' and eig_method == 'topk' else None)
+        cache = _load_ref_cache(ref_filepref, cache_key)
+        if cache is not None:
+            X_mean, X_std = cache['X_mean'], cache['X_std']
+            s, U, V, pcs_ref = cache['s'], cache['U'], cache['V'], cache['pcs_ref']
+        else:
             logging.info('Calculating REFERENCE PCA....')
-            X, X_bim, X_fam = read_bed(ref_filepref, dtype=np.float32)
-            X_mean, X_std = standardize(X)
+            X_bim, X_fam = read_bim_fam(ref_filepref)
             if method == 'oadp':
-                s, V = eig_ref(X)[:2]
+                eig_dim = dim_online if eig_method == 'topk' else None
+                X_mean, X_std, s, V = eig_ref_streamed(ref_filepref, ref_block_size, eig_dim, eig_tol)[:4]
+                V = V[:, :dim_online]
+                U = project_ref_streamed(ref_filepref, X_mean, X_std, V / s[:dim_online], ref_block_size)
             elif method == 'randoadp':
+                X = read_bed(ref_filepref, dtype=np.float32)[0]
+                X_mean, X_std = standardize(X)
                 s, V = randomized_svd(X, dim_rand)[:2]
-            V = V[:, :dim_online]
+                V = V[:, :dim_online]
+                U = X @ (V / s[:dim_online])
             pcs_ref = V[:, :dim_ref] * s[:dim_ref]
-            U = X @ (V / s[:dim_online])
-            np.savetxt(ref_filepref+'_mnsd.dat', np.hstack((X_mean, X_std)), fmt=output_fmt)
-            np.savetxt(ref_filepref+'_s.dat', s, fmt=output_fmt)
-            np.savetxt(ref_filepref+'_V.dat', V, fmt=output_fmt)
-            np.savetxt(ref_filepref+'_U.dat', U, fmt=output_fmt)
+            # The reference files are in place before the cache entry that lets other runs skip to reading them
             _write_pcs(pcs_ref, X_fam, colnames_pcs, ref_filepref, output_fmt)
             save_vars_bim(X_bim, ref_filepref+'_vars.dat')
-        pca_stu_kwargs = {'U':U, 's':s, 'V':V, 'pcs_ref':pcs_ref, 'dim_ref':dim_ref, 'dim_stu':dim_stu, 'dim_online':dim_online}
+            _save_ref_cache(ref_filepref, cache_key, X_mean=X_mean, X_std=X_std, s=s, U=U, V=V, pcs_ref=pcs_ref)
+        pca_stu_kwargs = {'U':U, 's':s, 'V':V, 'pcs_ref':pcs_ref, 'dim_ref':dim_ref, 'dim_stu':dim_stu, 'dim_online':dim_online,
+                          'block_size':block_size, 'procrustes_iter_max':procrustes_iter_max,
+                          'procrustes_warm_start':procrustes_warm_start}
 
     # Commented to remove requirement for R
     # if method == 'ap':
@@ -477,27 +852,21 @@ def pca(ref_filepref, stu_filepref=None, stu_filt_iid=None, out_filepref=None, m
     #     pca_stu_kwargs = {'U':Ushrink, 'dim_ref':dim_ref}
 
     if method == 'sp':
-        saved_filesuffs = ['_mnsd.dat', '_U.dat']
-        saved_allexist = all([os.path.isfile(ref_filepref+suff) for suff in saved_filesuffs])
-        try:
-            logging.info('Attemping to load saved reference PCA result...')
-            X_mean, X_std = _load_mnsd(ref_filepref)
-            U = np.loadtxt(ref_filepref+'_U.dat')[:, :dim_ref]
-            logging.info('Warning: If you have changed the parameter settings, please delete '
-                         + ref_filepref + '_*.dat and ' + ref_filepref + '.pcs then rerun FRAPOSA.')
-            logging.info('Reference PCA result loaded.')
-        except OSError:
-            logging.info('REFERENCE PCA result is either nonexistent or incomplete.')
+        cache_key = _ref_cache_key(ref_filepref, method=method, dim_ref=dim_ref, eig_method=eig_method,
+                                   eig_tol=eig_tol if eig_method == 'topk' else None)
+        cache = _load_ref_cache(ref_filepref, cache_key)
+        if cache is not None:
+            X_mean, X_std, U = cache['X_mean'], cache['X_std'], cache['U']
+        else:
             logging.info('Calculating REFERENCE PCA....')
-            X, X_bim, X_fam = read_bed(ref_filepref, dtype=np.float32)
-            X_mean, X_std = standardize(X)
-            s, V = eig_ref(X)[:2]
+            X_bim, X_fam = read_bim_fam(ref_filepref)
+            eig_dim = dim_ref if eig_method == 'topk' else None
+            X_mean, X_std, s, V = eig_ref_streamed(ref_filepref, ref_block_size, eig_dim, eig_tol)[:4]
             V = V[:, :dim_ref]
             pcs_ref = V[:, :dim_ref] * s[:dim_ref]
-            U = X @ (V / s[:dim_ref])
-            np.savetxt(ref_filepref+'_mnsd.dat', np.hstack((X_mean, X_std)), fmt=output_fmt)
+            U = project_ref_streamed(ref_filepref, X_mean, X_std, V / s[:dim_ref], ref_block_size)
+            _save_ref_cache(ref_filepref, cache_key, X_mean=X_mean, X_std=X_std, U=U)
             _write_pcs(pcs_ref, X_fam, colnames_pcs, ref_filepref, output_fmt)
-            np.savetxt(ref_filepref+'_U.dat', U, fmt=output_fmt)
             save_vars_bim(X_bim, ref_filepref + '_vars.dat')
         pca_stu_kwargs = {'U':U, 'dim_ref':dim_ref}
 
@@ -548,7 +917,10 @@ def pca(ref_filepref, stu_filepref=None, stu_filt_iid=None, out_filepref=None, m
         logging.info(datetime.now())
         logging.info('Predicting study PC scores (method: ' + method + ')...')
         t0 = time.time()
-        pcs_stu = pca_stu(W, X_mean, X_std, method, **pca_stu_kwargs)
+        if n_workers > 1:
+            pcs_stu = pca_stu_parallel(W, X_mean, X_std, method, n_workers, **pca_stu_kwargs)
+        else:
+            pcs_stu = pca_stu(W, X_mean, X_std, method, **pca_stu_kwargs)
         elapse_stu = time.time() - t0
 
         # Write output
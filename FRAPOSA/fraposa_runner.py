@@ -17,6 +17,13 @@ def main():
     parser.add_argument('--dim_rand', help='Number of reference PCs to calculate when using randomized online SVD')
     parser.add_argument('--dim_spikes', help='Number of PCs to adjust for shrinkage. Only needed for the ap method. If this argument is not set, dim_spikes_max will be used.')
     parser.add_argument('--dim_spikes_max', help='The maximal number of PCs to adjust for shrinkage. Only needed for the ap method. This argument will be ignored if dim_spikes is set. Default is 4*dim_ref.')
+    parser.add_argument('--block_size', help='Number of study samples standardized and projected per call. Only used by the oadp method; 1 projects one sample at a time. Default is 256.')
+    parser.add_argument('--ref_block_size', help='Number of reference variants read and standardized at a time when building the reference PCA. Default is 4096.')
+    parser.add_argument('--eig_method', help='Eigendecomposition of the reference covariance matrix. dense: all components (np.linalg.eigh). topk: only the components that are kept, by Lanczos iteration. Default is dense.')
+    parser.add_argument('--eig_tol', help='Convergence tolerance for --eig_method topk. Default is 1e-10.')
+    parser.add_argument('--procrustes_iter', help='Fixed iteration budget for the per-sample Procrustes alignment in oadp. The result is checked against fully converged alignments on the first study samples. Default is to iterate until convergence (at most 10000).')
+    parser.add_argument('--procrustes_warm_start', action='store_true', help='Start each Procrustes alignment from the previous study sample instead of from scratch. Faster, but the PCs then depend (within the convergence tolerance) on sample order, --block_size and --threads.')
+    parser.add_argument('--threads', '--workers', dest='threads', help='Number of worker processes the study samples are split across. Default is 1.')
     parser.add_argument('--out', help='Prefix of output file(s). Default is stu_filepref')
     args=parser.parse_args()
 
@@ -30,6 +37,12 @@ def main():
     dim_rand = None
     dim_spikes = None
     dim_spikes_max = None
+    block_size = 256
+    n_workers = 1
+    ref_block_size = 4096
+    eig_method = 'dense'
+    eig_tol = 1e-10
+    procrustes_iter_max = None
 
     if args.stu_filepref:
         stu_filepref = args.stu_filepref
@@ -66,10 +79,24 @@ def main():
         dim_spikes = int(args.dim_spikes)
     if args.dim_spikes_max:
         dim_spikes_max = int(args.dim_spikes_max)
+    if args.block_size:
+        block_size = int(args.block_size)
+    if args.threads:
+        n_workers = int(args.threads)
+    if args.ref_block_size:
+        ref_block_size = int(args.ref_block_size)
+    if args.eig_method:
+        eig_method = args.eig_method
+    if args.eig_tol:
+        eig_tol = float(args.eig_tol)
+    if args.procrustes_iter:
+        procrustes_iter_max = int(args.procrustes_iter)
 
     fp.pca(ref_filepref=ref_filepref, stu_filepref=stu_filepref, stu_filt_iid=stu_filt_iid, out_filepref=out_filepref,
            method=method, dim_ref=dim_ref, dim_stu=dim_stu, dim_online=dim_online, dim_rand=dim_rand,
-           dim_spikes=dim_spikes, dim_spikes_max=dim_spikes_max)
+           dim_spikes=dim_spikes, dim_spikes_max=dim_spikes_max, block_size=block_size, n_workers=n_workers,
+           ref_block_size=ref_block_size, eig_method=eig_method, eig_tol=eig_tol,
+           procrustes_iter_max=procrustes_iter_max, procrustes_warm_start=args.procrustes_warm_start)
 
 
 if __name__ == '__main__':
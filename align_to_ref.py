@@ -0,0 +1,115 @@
+import shutil
+import sys
+
+import numpy as np
+import pandas as pd
+
+from align_variant import COMPLEMENT, TGT_COLUMNS, read_bim, load_panel_index, harmonize
+from FRAPOSA.bed import MISSING, Bed, create_bed, encode, missing_row
+
+
+def oriented_sources(panel, tgt, actual_keep, flip_ids):
+    """For each reference row, the target row holding its genotypes (-1 if absent) and whether the target
+    alleles are swapped relative to the reference A1/A2 once strand flips are applied"""
+    keep = pd.DataFrame({'tgt_row': actual_keep.index.to_numpy(dtype=np.int64),
+                         'id_ref': actual_keep.to_numpy()})
+    keep = keep.drop_duplicates('id_ref') # --update-name would otherwise create duplicated ids
+    src = pd.DataFrame({'id_ref': panel.ids}).merge(keep, on='id_ref', how='left')['tgt_row']
+    src = src.fillna(-1).to_numpy(dtype=np.int64)
+
+    has_src = src >= 0
+    rows = src[has_src]
+    r1 = panel.allele_strings('a1')[has_src]
+    r2 = panel.allele_strings('a2')[has_src]
+    t1 = tgt['ta1'].astype(str).str.upper().to_numpy()[rows]
+    t2 = tgt['ta2'].astype(str).str.upper().to_numpy()[rows]
+    flip = np.isin(rows, flip_ids)
+    complement = np.vectorize(lambda a: COMPLEMENT.get(a, a), otypes=[object])
+    if flip.any():
+        t1[flip] = complement(t1[flip])
+        t2[flip] = complement(t2[flip])
+    same = (t1 == r1) & (t2 == r2)
+    swapped = (t1 == r2) & (t2 == r1) & ~same
+
+    # Alleles that fit neither orientation cannot be forced to the reference and are left missing
+    src[np.flatnonzero(has_src)[~(same | swapped)]] = -1
+    is_swapped = np.zeros(len(panel.ids), dtype=bool)
+    is_swapped[has_src] = swapped
+    return src, is_swapped
+
+
+def write_aligned(tgt_pref, panels, n_tgt_variants, block_size=4096):
+    """Writes the target genotypes in each panel's variant order and allele coding as one .bed/.bim/.fam per
+    panel. panels holds (out_pref, panel, src, is_swapped); the target rows used by any panel are read and
+    decoded once, in a single ascending pass over the target .bed"""
+    bed = Bed(tgt_pref, n_variants=n_tgt_variants)
+    dummy = missing_row(bed.n_samples) # Absent reference variants are spliced in as this constant byte row
+    used = np.unique(np.concatenate([src[src >= 0] for _, _, src, _ in panels]))
+
+    outputs = []
+    for out_pref, panel, src, is_swapped in panels:
+        out = create_bed(out_pref, len(panel.ids), bed.n_samples)
+        out[src < 0] = dummy
+        # Destination rows ordered by the position of their source row in the scan
+        dest = np.flatnonzero(src >= 0)
+        scan_pos = np.searchsorted(used, src[dest])
+        order = np.argsort(scan_pos, kind='stable')
+        outputs.append((out, dest[order], scan_pos[order], is_swapped))
+
+    for start in range(0, len(used), block_size):
+        stop = min(start + block_size, len(used))
+        geno_block = bed.read(used[start:stop])
+        for out, dest, scan_pos, is_swapped in outputs:
+            lo, hi = np.searchsorted(scan_pos, [start, stop])
+            if lo == hi:
+                continue
+            geno = geno_block[scan_pos[lo:hi] - start]
+            swap = is_swapped[dest[lo:hi]]
+            geno[swap] = np.where(geno[swap] == MISSING, MISSING, 2 - geno[swap])
+            out[dest[lo:hi]] = encode(geno)
+
+    for (out_pref, panel, _, _), (out, _, _, _) in zip(panels, outputs):
+        if isinstance(out, np.memmap):
+            out.flush()
+        shutil.copyfile(panel.bim_path, out_pref + '.bim')
+        shutil.copyfile(tgt_pref + '.fam', out_pref + '.fam')
+
+
+def align_panels(tgt_pref, panels, block_size=4096):
+    """Aligns a target PLINK dataset to one or more reference panels, given as (out_pref, ref_pref) pairs:
+    keeps target variants matching each reference by chr:pos and alleles (directly or after a strand flip),
+    recodes them to the reference A1/A2, fills absent reference variants with missing genotypes and writes
+    each panel in reference order. The target .bim and .bed are read once for all panels"""
+    tgt = read_bim(tgt_pref, TGT_COLUMNS)
+    n_tgt_variants = len(tgt)
+    tgt['id_tgt'] = np.arange(n_tgt_variants) # Target rows act as unique variant ids
+
+    aligned = []
+    for out_pref, ref_pref in panels:
+        panel = load_panel_index(ref_pref)
+        actual_keep, final_remove, flip_ids = harmonize(panel, tgt)
+        src, is_swapped = oriented_sources(panel, tgt, actual_keep, flip_ids.to_numpy())
+        aligned.append((out_pref, panel, src, is_swapped))
+        n_kept = np.sum(src >= 0)
+        print(f"{ref_pref}: RefTotal={len(panel.ids)} | Kept={n_kept} (Flipped={len(flip_ids)}, "
+              f"Swapped={is_swapped.sum()}) | Dummy={len(panel.ids) - n_kept}")
+
+    write_aligned(tgt_pref, aligned, n_tgt_variants, block_size)
+    for out_pref, _ in panels:
+        print(f"Aligned genotypes written to {out_pref}.bed")
+
+
+def align(tgt_pref, out_pref, ref_pref, block_size=4096):
+    align_panels(tgt_pref, [(out_pref, ref_pref)], block_size)
+
+
+def main():
+    # Usage: align_to_ref.py TargetPrefix OutputPrefix ReferencePrefix [OutputPrefix ReferencePrefix ...]
+    tgt_pref, pairs = sys.argv[1], sys.argv[2:]
+    if len(pairs) == 0 or len(pairs) % 2:
+        sys.exit("Usage: align_to_ref.py TargetPrefix OutputPrefix ReferencePrefix [OutputPrefix ReferencePrefix ...]")
+    align_panels(tgt_pref, list(zip(pairs[::2], pairs[1::2])))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,74 +1,205 @@
-import pandas as pd
+import json
+import os
 import sys
+from dataclasses import dataclass
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', '0': '0'}
+BASE_ALLELES = ['0', 'A', 'C', 'G', 'T']
+
+# Compiled panel index: reference rows sorted by (chromosome code << 32 | position), with allele codes
+INDEX_VERSION = 2
+INDEX_DTYPE = np.dtype([('key', np.int64), ('row', np.int64), ('a1', np.int32), ('a2', np.int32)])
+
+REF_COLUMNS = ["chr", "id_ref", "cm", "pos", "a1", "a2"]
+TGT_COLUMNS = ["chr", "id_tgt", "cm", "pos", "ta1", "ta2"]
+
+
+def read_bim(pref, names):
+    return pd.read_csv(f"{pref}.bim", sep=r"\s+", header=None, names=names)
+
+
+def read_bims(ref_pref, tgt_pref):
+    return read_bim(ref_pref, REF_COLUMNS), read_bim(tgt_pref, TGT_COLUMNS)
+
+
+@dataclass
+class Panel:
+    """A reference panel compiled for matching: the index sorted by position key, its allele and chromosome
+    vocabularies, the variant ids in .bim order and the path of the reference .bim"""
+    index: np.ndarray
+    alleles: List[str]
+    chroms: List[str]
+    ids: np.ndarray
+    bim_path: str
+
+    def allele_strings(self, field):
+        """Upper-cased reference a1 or a2 of every variant, in .bim order"""
+        codes = np.empty(len(self.ids), dtype=np.int32)
+        codes[self.index['row']] = self.index[field]
+        return np.array(self.alleles, dtype=object)[codes]
+
+
+def chrom_names(bim):
+    """Chromosome names as compared when matching: exact strings without a 'chr' prefix (in any case)"""
+    return bim['chr'].astype(str).str.replace('chr', '', case=False).to_numpy()
+
+
+def position_keys(bim, chroms):
+    """chr:pos as one int64 per variant, with the chromosome coded by its position in chroms. Names not in
+    chroms get a negative key that no reference variant has"""
+    codes = pd.Index(chroms).get_indexer(chrom_names(bim)).astype(np.int64)
+    return (codes << 32) | bim['pos'].to_numpy(dtype=np.int64)
+
+
+def allele_codes(alleles, vocab):
+    """Codes of upper-cased alleles in vocab, -1 for alleles outside it"""
+    lookup = {a: i for i, a in enumerate(vocab)}
+    return alleles.astype(str).str.upper().map(lookup).fillna(-1).to_numpy(dtype=np.int32)
 
-def main():
-    
-    ref_pref, tgt_pref = sys.argv[1], sys.argv[2]
 
-    ref = pd.read_csv(f"{ref_pref}.bim", sep="\s+", header=None, 
-                     names=["chr", "id_ref", "cm", "pos", "a1", "a2"])
-    tgt = pd.read_csv(f"{tgt_pref}.bim", sep="\s+", header=None, 
-                     names=["chr", "id_tgt", "cm", "pos", "ta1", "ta2"])
-
-    # 1. Coordinate Normalization
-    ref['chr_n'] = ref['chr'].astype(str).str.replace('chr', '', case=False)
-    tgt['chr_n'] = tgt['chr'].astype(str).str.replace('chr', '', case=False)
-    ref['m_key'] = ref['chr_n'] + ":" + ref['pos'].astype(str)
-    tgt['m_key'] = tgt['chr_n'] + ":" + tgt['pos'].astype(str)
-
-    # 2. Identify Matches
-    merged = pd.merge(ref, tgt, on="m_key")
-    complement = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', '0': '0',
-                  'a': 't', 'c': 'g', 'g': 'c', 't': 'a'}
-
-    # We use dictionaries to prevent the "Double Flagging" you encountered
-    # Key = Target ID
-    final_keep = {}    # {tgt_id: ref_id}
-    final_remove = set()
-    final_flip = set()
-
-    for _, row in merged.iterrows():
-        r1, r2 = str(row['a1']).upper(), str(row['a2']).upper()
-        t1, t2 = str(row['ta1']).upper(), str(row['ta2']).upper()
-        tid, rid = row['id_tgt'], row['id_ref']
-        ct1, ct2 = complement.get(t1, t1), complement.get(t2, t2)
-
-        is_match = (r1 == t1 and r2 == t2) or (r1 == t2 and r2 == t1)
-        is_flip = (r1 == ct1 and r2 == ct2) or (r1 == ct2 and r2 == ct1)
-
-        if is_match:
-            final_keep[tid] = rid
-        elif is_flip:
-            final_keep[tid] = rid
-            final_flip.add(tid)
-        else:
-            # Case 1 & 3: If it fails once, it must be removed 
-            # even if another record at this position matched.
-            final_remove.add(tid)
+def build_panel_index(ref):
+    """Index, allele vocabulary and chromosome vocabulary of a reference .bim"""
+    a1 = ref['a1'].astype(str).str.upper()
+    a2 = ref['a2'].astype(str).str.upper()
+    vocab = BASE_ALLELES + sorted(set(a1).union(a2).difference(BASE_ALLELES))
+    chroms = sorted(set(chrom_names(ref)))
+    keys = position_keys(ref, chroms)
+    order = np.argsort(keys, kind='stable')
+    index = np.empty(len(ref), dtype=INDEX_DTYPE)
+    index['key'] = keys[order]
+    index['row'] = order
+    index['a1'] = allele_codes(ref['a1'], vocab)[order]
+    index['a2'] = allele_codes(ref['a2'], vocab)[order]
+    return index, vocab, chroms
+
+
+def bim_stamp(ref_pref):
+    st = os.stat(f"{ref_pref}.bim")
+    return [st.st_size, st.st_mtime_ns]
+
+
+def load_panel_index(ref_pref, ref=None):
+    """Loads the panel compiled next to the reference .bim ({ref_pref}.posidx.*), compiling and saving it first
+    if it is missing or the .bim has changed size or modification time since. A compiled panel is used without
+    reading the .bim"""
+    paths = {ext: f"{ref_pref}.posidx{ext}" for ext in ['.npy', '.ids.npy', '.json']}
+    stamp = bim_stamp(ref_pref)
+    try:
+        with open(paths['.json']) as f:
+            meta = json.load(f)
+        if meta['version'] == INDEX_VERSION and meta['bim_stamp'] == stamp:
+            return Panel(np.load(paths['.npy'], mmap_mode='r'), meta['alleles'], meta['chroms'],
+                         np.load(paths['.ids.npy']), f"{ref_pref}.bim")
+    except (OSError, ValueError, KeyError):
+        pass
+
+    print(f"Compiling position index for {ref_pref}.bim")
+    if ref is None:
+        ref = read_bim(ref_pref, REF_COLUMNS)
+    index, vocab, chroms = build_panel_index(ref)
+    ids = ref['id_ref'].astype(str).to_numpy(dtype=str)
+    # Written under temporary names and renamed into place, metadata last, so that concurrent runs never load
+    # a partial panel
+    tmp = {ext: f"{path}.{os.getpid()}.tmp" for ext, path in paths.items()}
+    try:
+        with open(tmp['.npy'], 'wb') as f:
+            np.save(f, index)
+        with open(tmp['.ids.npy'], 'wb') as f:
+            np.save(f, ids)
+        with open(tmp['.json'], 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'bim_stamp': stamp, 'alleles': vocab, 'chroms': chroms}, f)
+        for ext in paths:
+            os.replace(tmp[ext], paths[ext])
+    except OSError as e:
+        print(f"Warning: could not save position index for {ref_pref}.bim ({e})")
+    return Panel(index, vocab, chroms, ids, f"{ref_pref}.bim")
+
+
+def join_positions(panel, tgt):
+    """All (reference row, target row, index position) pairs sharing chr:pos, found by sorted-array search
+    and ordered like pd.merge(ref, tgt): by reference row, then target row"""
+    index = panel.index
+    keys = position_keys(tgt, panel.chroms)
+    lo = np.searchsorted(index['key'], keys, side='left')
+    hi = np.searchsorted(index['key'], keys, side='right')
+    counts = hi - lo
+    tgt_rows = np.repeat(np.arange(len(tgt)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    idx_pos = np.repeat(lo, counts) + offsets
+    ref_rows = index['row'][idx_pos]
+    order = np.lexsort((tgt_rows, ref_rows))
+    return ref_rows[order], tgt_rows[order], idx_pos[order]
+
+
+def classify_alleles(r1, r2, t1, t2, vocab):
+    """Returns (is_match, is_flip) for reference/target allele code pairs (codes in vocab, -1 if outside it)"""
+    # Code of each allele's strand complement; -1 (never equal to a reference code) if outside vocab
+    lookup = {a: i for i, a in enumerate(vocab)}
+    comp_code = np.array([lookup.get(COMPLEMENT.get(a, a), -1) for a in vocab] + [-1], dtype=np.int32)
+    ct1, ct2 = comp_code[t1], comp_code[t2] # t == -1 picks the trailing -1
+
+    is_match = ((r1 == t1) & (r2 == t2)) | ((r1 == t2) & (r2 == t1))
+    is_flip = ((r1 == ct1) & (r2 == ct2)) | ((r1 == ct2) & (r2 == ct1))
+    return is_match, is_flip
+
+
+def harmonize(panel, tgt):
+    """Matches target to reference variants by chr:pos and sorts target ids into keep/flip/remove, given the
+    reference panel from load_panel_index"""
+    index, vocab = panel.index, panel.alleles
+
+    # 1. Identify Matches
+    ref_rows, tgt_rows, idx_pos = join_positions(panel, tgt)
+    merged = pd.DataFrame({'id_ref': panel.ids[ref_rows],
+                           'id_tgt': tgt['id_tgt'].to_numpy()[tgt_rows]})
+    is_match, is_flip = classify_alleles(index['a1'][idx_pos], index['a2'][idx_pos],
+                                         allele_codes(tgt['ta1'], vocab)[tgt_rows],
+                                         allele_codes(tgt['ta2'], vocab)[tgt_rows], vocab)
+    is_keep = is_match | is_flip
+
+    # A target id is kept if any of its pairs match (directly or after a strand flip), mapped to the
+    # reference id of its last matching pair. If any pair fails, it must be removed even if another
+    # record at this position matched.
+    kept = merged.loc[is_keep, ['id_tgt', 'id_ref']]
+    final_keep = kept.drop_duplicates('id_tgt', keep='last').set_index('id_tgt')['id_ref']
+    final_keep = final_keep.reindex(kept['id_tgt'].drop_duplicates())
+    final_remove = merged.loc[~is_keep, 'id_tgt'].drop_duplicates()
+    final_flip = merged.loc[is_keep & ~is_match, 'id_tgt']
 
     # --- THE CLEANUP STEP ---
     # If a variant is in remove, it cannot be in keep.
     # This prevents the "--exclude" priority from creating a 63-variant gap.
-    actual_keep_tgt_ids = [tid for tid in final_keep if tid not in final_remove]
-    actual_update_map = [[tid, final_keep[tid]] for tid in actual_keep_tgt_ids]
-    actual_flip_ids = [tid for tid in final_flip if tid in actual_keep_tgt_ids]
+    actual_keep = final_keep[~final_keep.index.isin(final_remove)]
+    actual_flip_ids = actual_keep.index[actual_keep.index.isin(final_flip)]
+    return actual_keep, final_remove, actual_flip_ids
+
+
+def main():
+
+    ref_pref, tgt_pref = sys.argv[1], sys.argv[2]
+
+    ref, tgt = read_bims(ref_pref, tgt_pref)
+    actual_keep, final_remove, actual_flip_ids = harmonize(load_panel_index(ref_pref, ref), tgt)
 
     # --- THE MASTER DUMMY SET ---
     # DUMMY = Everything in Reference - (Actually Kept)
-    kept_ref_ids = set([x[1] for x in actual_update_map])
-    dummy_df = ref[~ref['id_ref'].isin(kept_ref_ids)].copy()
+    dummy_df = ref[~ref['id_ref'].astype(str).isin(actual_keep.values)].copy()
 
     # 3. Output
-    pd.Series(actual_keep_tgt_ids).to_csv("keep.txt", index=False, header=False)
-    pd.Series(list(final_remove)).to_csv("remove.txt", index=False, header=False)
+    pd.Series(actual_keep.index).to_csv("keep.txt", index=False, header=False)
+    final_remove.to_csv("remove.txt", index=False, header=False)
     pd.Series(actual_flip_ids).to_csv("flip.txt", index=False, header=False)
-    pd.DataFrame(actual_update_map).to_csv("update_ids.txt", sep="\t", index=False, header=False)
-    
+    actual_keep.reset_index().to_csv("update_ids.txt", sep="\t", index=False, header=False)
+
     dummy_df[['chr', 'id_ref', 'cm', 'pos', 'a1', 'a2']].to_csv(
         "dummy_template.bim", sep="\t", index=False, header=False)
 
-    print(f"Stats: RefTotal={len(ref)} | Kept={len(actual_keep_tgt_ids)} | Dummy={len(dummy_df)}")
-    print(f"Check sum: {len(actual_keep_tgt_ids) + len(dummy_df)} (Should match RefTotal)")
+    print(f"Stats: RefTotal={len(ref)} | Kept={len(actual_keep)} | Dummy={len(dummy_df)}")
+    print(f"Check sum: {len(actual_keep) + len(dummy_df)} (Should match RefTotal)")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
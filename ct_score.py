@@ -0,0 +1,97 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from align_variant import COMPLEMENT
+from prs_score import accumulate, read_plink
+
+AMBIGUOUS = {('A', 'T'), ('T', 'A'), ('C', 'G'), ('G', 'C')}
+
+
+def read_sumstat(path, stat='OR'):
+    """Reads a PRSice-style base file (columns SNP, A1 effect allele, A2, P and the statistic). OR is converted to
+    log(OR) weights, BETA is used as is"""
+    ss = pd.read_csv(path, sep=r"\s+", usecols=['SNP', 'A1', 'A2', 'P', stat], dtype={'SNP': str, 'A1': str, 'A2': str})
+    ss['A1'] = ss['A1'].str.upper()
+    ss['A2'] = ss['A2'].str.upper()
+    ss['weight'] = np.log(ss[stat]) if stat == 'OR' else ss[stat]
+    return ss[np.isfinite(ss['weight']) & ss['P'].notna()]
+
+
+def match_sumstat(bim, ss, keep_ambig=False):
+    """Matches base variants to the .bim by id and alleles, directly or on the opposite strand. Returns the .bim
+    row of every base variant (-1 if unmatched) and whether its effect allele is the .bim A1"""
+    row = pd.Index(bim['id']).drop_duplicates().get_indexer(ss['SNP'])
+    found = row >= 0
+    a1 = bim['a1'].astype(str).str.upper().to_numpy()[np.where(found, row, 0)]
+    a2 = bim['a2'].astype(str).str.upper().to_numpy()[np.where(found, row, 0)]
+    e1, e2 = ss['A1'].to_numpy(), ss['A2'].to_numpy()
+    c1 = np.array([COMPLEMENT.get(a, a) for a in e1], dtype=object)
+    c2 = np.array([COMPLEMENT.get(a, a) for a in e2], dtype=object)
+    on_a1 = ((e1 == a1) & (e2 == a2)) | ((c1 == a1) & (c2 == a2))
+    on_a2 = ((e1 == a2) & (e2 == a1)) | ((c1 == a2) & (c2 == a1))
+    matched = found & (on_a1 | on_a2)
+    if not keep_ambig:
+        # Strand-ambiguous variants are dropped, as PRSice does without --keep-ambig
+        matched &= ~np.array([(x, y) in AMBIGUOUS for x, y in zip(a1, a2)])
+    print(f"Base: {len(ss)} variants, {matched.sum()} matched to the target "
+          f"({(~found).sum()} not found, {(found & ~matched).sum()} with mismatched or ambiguous alleles)")
+    return np.where(matched, row, -1), on_a1 & matched
+
+
+def score_thresholds(bfile, sumstat, thresholds, stat='OR', method='avg', keep_ambig=False, block_size=4096):
+    """Clumping-and-thresholding scores of every sample at each p-value threshold, from one pass over the .bed,
+    as PRSice --fastscore --no-regress: a variant counts towards all thresholds >= its P. Variants are binned by
+    the smallest threshold they pass, each bin is scored as one weight column, and the per-threshold scores are
+    cumulative sums over the bins. With method='avg' the scores are divided by 2 x the number of variants
+    included (missing genotypes are mean-imputed, so they count too)"""
+    bim, fam, bed = read_plink(bfile)
+    ss = read_sumstat(sumstat, stat)
+    row, on_a1 = match_sumstat(bim, ss, keep_ambig)
+    thresholds = np.sort(np.asarray(thresholds, dtype=np.float64))
+    bins = np.searchsorted(thresholds, ss['P'].to_numpy(), side='left')
+    use = (row >= 0) & (bins < len(thresholds))
+
+    scored, rows = np.unique(row[use], return_inverse=True)
+    if len(scored) < use.sum():
+        raise ValueError(f"{sumstat} has several base variants matching the same target variant")
+    shape = (len(scored), len(thresholds))
+    W = sparse.csr_matrix((ss['weight'].to_numpy()[use], (rows, bins[use])), shape=shape)
+    base = np.full(shape, np.nan)
+    base[rows, bins[use]] = np.where(on_a1[use], 2.0, 0.0)
+    total, _, _, n_variants = accumulate(bed, scored, W, base, block_size)
+
+    total, n_variants = np.cumsum(total, axis=0), np.cumsum(n_variants)
+    out = fam[['FID', 'IID']].copy()
+    for k, t in enumerate(thresholds):
+        print(f"Pt_{t:g}: {n_variants[k]} variants")
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out[f"Pt_{t:g}"] = total[k] / (2 * n_variants[k]) if method == 'avg' else total[k]
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Clumping-and-thresholding polygenic scores for a list of p-value "
+                                                 "thresholds from a pre-clumped base file, as PRSice --fastscore --no-regress")
+    parser.add_argument('--base', required=True, help='Summary statistics with SNP, A1, A2, P and OR/BETA columns')
+    parser.add_argument('--target', required=True, help='Target PLINK binary file prefix')
+    parser.add_argument('--bar-levels', required=True, help='Comma-separated p-value thresholds')
+    parser.add_argument('--stat', default='OR', help='Effect size column; OR is log-transformed. Default is OR')
+    parser.add_argument('--score', default='avg', choices=['avg', 'sum'],
+                        help='avg divides the scores by the number of alleles included. Default is avg')
+    parser.add_argument('--keep-ambig', action='store_true', help='Keep strand-ambiguous (A/T, C/G) variants')
+    parser.add_argument('--block-size', type=int, default=4096, help='Variants decoded at a time')
+    parser.add_argument('--out', required=True, help='Scores are written to <out>.all_score')
+    args = parser.parse_args()
+
+    thresholds = [float(t) for t in args.bar_levels.split(',')]
+    scores = score_thresholds(args.target, args.base, thresholds, args.stat, args.score, args.keep_ambig,
+                              args.block_size)
+    scores.to_csv(f"{args.out}.all_score", sep=' ', index=False, float_format='%.6g')
+    print(f"Scores for {len(scores)} samples written to {args.out}.all_score")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from FRAPOSA.bed import Bed
+
+# FRAPOSA genotype codes (2 - A1 count, 3 missing) -> A1 allele counts as in plink --recode A, -1 for missing
+MISSING_COUNT = -1
+CODE_COUNTS = np.array([2, 1, 0, MISSING_COUNT], dtype=np.int8)
+
+
+def export_features(bfile, panels, block_size=4096):
+    """Decodes the variants listed in each panel's id file, in that order, into an int8 (samples x variants) matrix
+    of A1 allele counts saved as <out>.npy, with the plink --recode A column names (<id>_<A1>) in <out>.names.
+    panels holds (varids_path, out_pref) pairs; the .bed rows of all panels are read in one ascending pass.
+    Listed variants absent from the .bim are exported as missing"""
+    bim = pd.read_csv(f"{bfile}.bim", sep=r"\s+", header=None, usecols=[1, 4], names=['id', 'a1'], dtype=str)
+    bed = Bed(bfile, n_variants=len(bim))
+    ids = pd.Index(bim['id']).drop_duplicates()
+
+    outputs = []
+    for varids_path, out_pref in panels:
+        varids = pd.read_csv(varids_path, sep=r"\s+", header=None, usecols=[0], dtype=str)[0]
+        rows = ids.get_indexer(varids)
+        if (rows < 0).any():
+            print(f"Warning: {(rows < 0).sum()} variants of {varids_path} are not in {bfile}.bim and are left missing")
+        a1 = np.where(rows >= 0, bim['a1'].to_numpy()[np.maximum(rows, 0)], '0')
+        with open(f"{out_pref}.names", 'w') as f:
+            f.write('\t'.join(varids + '_' + a1) + '\n')
+        out = np.lib.format.open_memmap(f"{out_pref}.npy", mode='w+', dtype=np.int8, shape=(bed.n_samples, len(varids)))
+        out[:, rows < 0] = MISSING_COUNT
+        outputs.append((out, rows))
+
+    used = np.unique(np.concatenate([rows[rows >= 0] for _, rows in outputs]))
+    for start in range(0, len(used), block_size):
+        block_rows = used[start:start + block_size]
+        counts = CODE_COUNTS[bed.read(block_rows)]
+        for out, rows in outputs:
+            cols = np.flatnonzero(np.isin(rows, block_rows))
+            if len(cols):
+                out[:, cols] = counts[np.searchsorted(block_rows, rows[cols])].T
+
+    for (out, _), (_, out_pref) in zip(outputs, panels):
+        out.flush()
+        print(f"Features {out.shape} written to {out_pref}.npy")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exports model input genotypes from PLINK binary files as .npy matrices")
+    parser.add_argument('bfile', help='Aligned PLINK binary file prefix')
+    parser.add_argument('panels', nargs='+', metavar='VARIDS OUT',
+                        help='Pairs of variant id file (one id per line, in model column order) and output prefix')
+    parser.add_argument('--pheno', help='Also writes the .fam (FID IID PAT MAT SEX PHENOTYPE) tab-delimited to this file')
+    parser.add_argument('--block-size', type=int, default=4096, help='Variants decoded at a time')
+    args = parser.parse_args()
+    if len(args.panels) % 2:
+        parser.error('panels must be given as VARIDS OUT pairs')
+
+    export_features(args.bfile, list(zip(args.panels[::2], args.panels[1::2])), args.block_size)
+    if args.pheno:
+        fam = pd.read_csv(f"{args.bfile}.fam", sep=r"\s+", header=None, dtype=str)
+        fam.to_csv(args.pheno, sep='\t', header=False, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import resource
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from feature_matrix import MISSING_COUNT
+
+
+def peak_memory_gb():
+    """Peak resident memory of this process so far (ru_maxrss is in KB on Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ** 2
+
+
+def check_features(X, names, block_size=4096, check_rows=None, seed=42):
+    """Integrity checks over a float32 matrix in one pass of column blocks: counts NaNs, replaces infinite values
+    with NaN in place, and finds constant columns (a single distinct non-missing value, like nunique() <= 1).
+    With check_rows, NaNs and constant columns are assessed on that many randomly sampled rows"""
+    rows = slice(None)
+    if check_rows is not None and check_rows < X.shape[0]:
+        rows = np.sort(np.random.default_rng(seed).choice(X.shape[0], check_rows, replace=False))
+    nan_count = inf_count = 0
+    constant = np.zeros(X.shape[1], dtype=bool)
+    for start in range(0, X.shape[1], block_size):
+        block = X[:, start:start + block_size]
+        is_inf = np.isinf(block)
+        n_inf = is_inf.sum()
+        if n_inf:
+            block[is_inf] = np.nan
+            inf_count += n_inf
+        sample = block[rows]
+        nan_count += np.isnan(sample).sum()
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning) # All-NaN columns
+            lo, hi = np.nanmin(sample, axis=0), np.nanmax(sample, axis=0)
+        constant[start:start + block_size] = ~(lo < hi)
+
+    sampled = '' if isinstance(rows, slice) else f" (in {len(rows)} sampled rows)"
+    if nan_count > 0:
+        print(f"⚠️  WARNING: Found {nan_count} NaN values{sampled}. XGBoost will handle them, but ensure this is expected.")
+    if inf_count > 0:
+        print(f"❌ CRITICAL: Found {inf_count} infinite values! Replaced with NaNs.")
+    if constant.any():
+        print(f"ℹ️  Note: Found {constant.sum()} columns with zero variance (constant values){sampled}.")
+    return [n for n, c in zip(names, constant) if c]
+
+
+def read_split_parts(feat_path, cov_path, name_path, label_path):
+    """Genotypes (memory-mapped if .npy), feature names, covariates, covariate names, sex, labels and ids of a split"""
+    names_df = pd.read_csv(name_path, sep=r'\s+', header = None, engine = 'python')
+    feature_names = names_df.iloc[0].values.tolist()
+    if feat_path.endswith('.npy'):
+        # Matrix exported by feature_matrix.py, read without a text round trip
+        X_main = np.load(feat_path, mmap_mode='r')
+    else:
+        X_main = pd.read_csv(feat_path, sep='\t', header=None, dtype=np.float32,
+                             engine='c', low_memory=False, memory_map=True, na_values=['-9','NA', '3']).to_numpy()
+
+    print(f"Data loaded with shape: {X_main.shape}, feature length: {len(feature_names)}")
+    if len(feature_names) != X_main.shape[1]:
+        print(f"Warning: Name count ({len(feature_names)}) does not match. Column count ({X_main.shape[1]}).")
+        feature_names = list(range(X_main.shape[1]))
+
+    cov = pd.read_csv(cov_path, sep='\t').iloc[:, 2:].to_numpy(dtype=np.float32)
+    cov_names = [f"Covariate{i+1}" for i in range(cov.shape[1])]
+
+    label_df = pd.read_csv(label_path, sep='\t', header=None)
+    print(label_df.shape)
+
+    # Binary encoding: 2 is 1 (Case), 1 is 0 (Control)
+    sex = (label_df.iloc[:, 4] == 2).astype(np.int8)
+    y = (label_df.iloc[:, 5] == 2).astype(np.int8)
+    id_df = label_df.iloc[:, 0:2]
+    return X_main, feature_names, cov, cov_names, sex, y, id_df
+
+
+def assemble_features(X_main, cov, sex, rows=slice(None), block_size=4096):
+    """Single float32 matrix of the genotypes, covariates and sex of the selected rows; int8 genotypes from
+    feature_matrix.py are converted one column block at a time"""
+    X_rows = X_main[rows]
+    n_geno = X_rows.shape[1]
+    X = np.empty((X_rows.shape[0], n_geno + cov.shape[1] + 1), dtype=np.float32)
+    for start in range(0, n_geno, block_size):
+        block = X_rows[:, start:start + block_size]
+        X[:, start:start + block.shape[1]] = block
+        if block.dtype == np.int8:
+            X[:, start:start + block.shape[1]][block == MISSING_COUNT] = np.nan
+    X[:, n_geno:-1] = cov[rows]
+    X[:, -1] = sex.to_numpy()[rows]
+    return X
+
+
+def load_data_split(feat_path, cov_path, name_path, label_path, check_rows=None, block_size=4096):
+    """Loads a specific split independently using memory-efficient dtypes.
+    Genotypes, covariates and sex are written into a single float32 matrix, wrapped by the returned DataFrame
+    without copying"""
+    X_main, feature_names, cov, cov_names, sex, y, id_df = read_split_parts(feat_path, cov_path, name_path, label_path)
+    X = assemble_features(X_main, cov, sex, block_size=block_size)
+    del X_main, cov
+
+    full_names = feature_names + cov_names + ['sex']
+    print(f"Final dimension of dataset {X.shape}")
+    print(f"Label breakdown: {np.unique(y, return_counts=True)}")
+
+    # --- Feature Matrix Integrity Check ---
+    print("\n[Integrity Check] Checking Feature Matrix X...")
+    check_features(X, full_names, block_size, check_rows)
+    print(f"[Integrity Check] Final Matrix Shape: {X.shape}\n")
+    print(f"Peak memory after loading: {peak_memory_gb():.2f} GB")
+
+    X = pd.DataFrame(X, columns=full_names, copy=False)
+    return X, y, full_names, id_df
+
+
+def iter_data_chunks(feat_path, cov_path, name_path, label_path, chunk_size, block_size=4096):
+    """Yields (X, y, full_names, id_df) as load_data_split returns them, for consecutive chunks of chunk_size
+    samples. Only the rows of the current chunk are read from the memory-mapped .npy genotypes"""
+    X_main, feature_names, cov, cov_names, sex, y, id_df = read_split_parts(feat_path, cov_path, name_path, label_path)
+    full_names = feature_names + cov_names + ['sex']
+    for start in range(0, X_main.shape[0], chunk_size):
+        rows = slice(start, start + chunk_size)
+        X = assemble_features(X_main, cov, sex, rows, block_size)
+        X[np.isinf(X)] = np.nan
+        yield pd.DataFrame(X, columns=full_names, copy=False), y.iloc[rows], full_names, id_df.iloc[rows]
+
+
+def genotype_medians(feat_path, chunk_size=10000):
+    """Per-column medians of the non-missing genotypes in a .npy matrix from feature_matrix.py, as
+    DataFrame.median() gives them (NaN for all-missing columns), from allele count histograms accumulated over
+    row chunks"""
+    X_main = np.load(feat_path, mmap_mode='r')
+    counts = np.zeros((3, X_main.shape[1]), dtype=np.int64)
+    for start in range(0, X_main.shape[0], chunk_size):
+        chunk = X_main[start:start + chunk_size]
+        for k in range(3):
+            counts[k] += (chunk == k).sum(axis=0)
+    # Median of the sorted values: mean of the values at the two middle ranks
+    n = counts.sum(axis=0)
+    cum = np.cumsum(counts, axis=0)
+    lower = (cum <= (n - 1) // 2).sum(axis=0)
+    upper = (cum <= n // 2).sum(axis=0)
+    return np.where(n > 0, (lower + upper) / 2, np.nan)
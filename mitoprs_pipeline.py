@@ -0,0 +1,373 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from string import Template
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+# PLINK 2 install location, appended to PATH
+PLINK_PATHS = ["~/plink2/"]
+
+
+@dataclass
+class Stage:
+    """One pipeline step: a bash script run once its dependencies have finished.
+    max_threads=None lets the stage use as much of the thread budget as is free when it starts.
+    inputs are the files read by the stage other than the outputs of its dependencies, outputs the files
+    later stages read; both are paths with ${variable} placeholders and together key the stage cache"""
+    name: str
+    script: str
+    deps: List[str] = field(default_factory=list)
+    max_threads: Optional[int] = 1
+    inputs: List[str] = field(default_factory=list)
+    outputs: List[str] = field(default_factory=list)
+
+
+def plink_files(pref):
+    return [f"{pref}.bed", f"{pref}.bim", f"{pref}.fam"]
+
+
+MITOPRS_STAGES = [
+    ## Aligning the target to all three reference panels in a single pass over the target genotypes:
+    ## 1KG (ancestry PCs using FRAPOSA), combinedbdset (PRSice/PRS-CSx), bd.allele.reference (XGB/ENet)
+    ## Missing Variants will be replaced with ref allele from input REF/ALT format
+    Stage("align", """
+bash align_to_ref.sh "${target}" "${work}/ancestry" "ref/1kgref.bip" \\
+                    "${work}/${tname}_mt" "ref/combinedbdset" \\
+                    "${work}/${tname}_model" "ref/bd.allele.reference"
+""", inputs=plink_files("${target}") + ["ref/1kgref.bip.bim", "ref/combinedbdset.bim", "ref/bd.allele.reference.bim",
+                                        "align_to_ref.sh", "align_to_ref.py", "align_variant.py", "FRAPOSA/bed.py"],
+         outputs=plink_files("${work}/ancestry") + plink_files("${work}/${tname}_mt") + plink_files("${work}/${tname}_model")),
+
+    # Re-organizing order of variants, forcing to ref of population, then forcing 1KG REF/ALT format
+    Stage("ancestry_common", """
+plink2 --bfile "${work}/ancestry" --extract ref/common_vars_bip.txt --fill-missing-with-ref --make-bed --threads "${threads}" --out "${work}/${tname}_tmp"
+plink2 --bfile "${work}/${tname}_tmp" --ref-allele ref/1kgref.bip.bim 6 2 --alt-allele ref/1kgref.bip.bim 5 2 --make-bed --threads "${threads}" --out "${work}/${tname}_common"
+""", deps=["align"], max_threads=None, inputs=["ref/common_vars_bip.txt", "ref/1kgref.bip.bim"],
+         outputs=plink_files("${work}/${tname}_common")),
+
+    Stage("fraposa", """
+python -m FRAPOSA.fraposa_runner --stu_filepref "${work}/${tname}_common" --dim_ref 5 --dim_online 20 --threads "${threads}" --out "${work}/${tname}" ref/1kgref.bip
+mv "${work}/${tname}".pcs "${work}/${tname}".oadp
+""", deps=["ancestry_common"], max_threads=None,
+         inputs=plink_files("ref/1kgref.bip") + ["FRAPOSA/fraposa.py", "FRAPOSA/fraposa_runner.py", "FRAPOSA/bed.py"],
+         outputs=["${work}/${tname}.oadp"]),
+
+    #Note summary statistic is already thresholded at p<0.2, and Clumped accordingly to the discovery data structure
+    #Scored in-process as PRSice-2 --fastscore --no-regress --no-clump --stat OR; add thresholds to --bar-levels as needed
+    Stage("prsice", """
+python ct_score.py \\
+      --base ref/BD.mitoPRS.sumstat.postCT.txt \\
+      --target "${work}/${tname}_mt" \\
+      --bar-levels 0.25 \\
+      --stat OR \\
+      --out "${work}/${outpre}"
+""", deps=["align"], inputs=["ref/BD.mitoPRS.sumstat.postCT.txt", "ct_score.py", "prs_score.py", "align_variant.py",
+                             "FRAPOSA/bed.py"],
+         outputs=["${work}/${outpre}.all_score"]),
+
+    # PRS-CSx weights, scored in-process like plink --score (further score sets can be added as more --score options)
+    Stage("prscsx", """
+python prs_score.py --bfile "${work}/${tname}_mt" --score ref/PRSCSx.bip.combined.txt 2 4 6 --out "${work}/${outpre}".csx
+""", deps=["align"], inputs=["ref/PRSCSx.bip.combined.txt", "prs_score.py", "FRAPOSA/bed.py"],
+         outputs=["${work}/${outpre}.csx.profile"]),
+
+    # Extracting Variants for Model Input: A1 counts in model column order, decoded straight from the .bed.
+    # Only the variants the XGBoost trees split on and those with non-zero ENet coefficients, once
+    # model_artifacts.py has listed them
+    Stage("features", """
+xgb_varids=model/0.15_xgb_model.used_varids.txt
+[ -e "$xgb_varids" ] || xgb_varids=ref/xgb_varids.txt
+enet_varids=model/0.3_enet_model.active_varids.txt
+[ -e "$enet_varids" ] || enet_varids=ref/enet_varids.txt
+python feature_matrix.py "${work}/${tname}_model" \\
+       "$xgb_varids" "${work}/${outpre}"_xgb \\
+       "$enet_varids" "${work}/${outpre}"_enet \\
+       --pheno "${work}/${outpre}".pheno
+""", deps=["align"], inputs=["ref/xgb_varids.txt", "ref/enet_varids.txt", "model/0.15_xgb_model.used_varids.txt",
+                             "model/0.3_enet_model.active_varids.txt", "feature_matrix.py", "FRAPOSA/bed.py"],
+         outputs=["${work}/${outpre}.pheno", "${work}/${outpre}_xgb.npy", "${work}/${outpre}_xgb.names",
+                  "${work}/${outpre}_enet.npy", "${work}/${outpre}_enet.names"]),
+
+    Stage("score", """
+python score_mitoprs.py --ext-feature "${work}/${outpre}" --ext-cov "${work}/${tname}".oadp --ext-label "${work}/${outpre}".pheno \\
+       --train-names "${work}/${outpre}" --out-prefix "${outpre}" --work-dir "${work}" --threads "${threads}" \\
+       ${MITOPRS_CHUNK_SIZE:+--chunk-size "$MITOPRS_CHUNK_SIZE"}
+""", deps=["fraposa", "prsice", "prscsx", "features"], max_threads=None,
+         inputs=["model/0.15_xgb_model.pkl", "model/0.3_enet_model.pkl", "model/0.15_xgb_model.ubj",
+                 "model/0.3_enet_model.npz", "score_mitoprs.py", "mitoprs_data.py", "mitoprs_utils.py", "model_artifacts.py",
+                 "feature_matrix.py"],
+         outputs=["output/${outpre}_predictions.csv"]),
+]
+
+
+def check_stages(stages):
+    names = set()
+    for stage in stages:
+        missing = [d for d in stage.deps if d not in names]
+        if missing:
+            raise ValueError(f"Stage {stage.name} depends on {missing}, which must be listed before it")
+        names.add(stage.name)
+
+
+def expand(paths, variables):
+    return [Template(p).substitute(variables) for p in paths]
+
+
+class StageCache:
+    """Stage outputs saved under <cache_dir>/<stage>/<key>, where the key hashes the stage script, the run's
+    target/output names, the keys of its dependencies, and the contents of the stage inputs and of its
+    dependencies' outputs. An entry's modification time is its last use, which prune() goes by"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.hash_file = os.path.join(cache_dir, 'file_hashes.json')
+        # Content hashes of unchanged files (same size and modification time) are reused across runs
+        try:
+            with open(self.hash_file) as f:
+                self.hashes = json.load(f)
+        except (OSError, ValueError):
+            self.hashes = {}
+
+    def file_hash(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return 'missing'
+        path = os.path.abspath(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        if path in self.hashes and self.hashes[path][:2] == stamp:
+            return self.hashes[path][2]
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 24), b''):
+                h.update(chunk)
+        self.hashes[path] = stamp + [h.hexdigest()]
+        return h.hexdigest()
+
+    def key(self, stage, variables, dep_keys, dep_outputs):
+        h = hashlib.sha256()
+        h.update(json.dumps([stage.name, stage.script, variables['target'], variables['tname'],
+                             variables['outpre']] + dep_keys).encode())
+        for path in expand(stage.inputs, variables) + dep_outputs:
+            h.update(self.file_hash(path).encode())
+        return h.hexdigest()
+
+    def restore(self, stage, key, variables):
+        """Links the cached outputs of the stage into place. Returns False if they are not cached"""
+        entry = os.path.join(self.cache_dir, stage.name, key)
+        if not os.path.isdir(entry):
+            return False
+        os.utime(entry)
+        for i, path in enumerate(expand(stage.outputs, variables)):
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            if os.path.exists(path):
+                os.remove(path)
+            link_or_copy(os.path.join(entry, str(i)), path)
+        return True
+
+    def store(self, stage, key, variables):
+        outputs = expand(stage.outputs, variables)
+        missing = [p for p in outputs if not os.path.exists(p)]
+        if missing:
+            print(f">>> Not caching {stage.name}: {missing} not found")
+            return
+        # Filled under a temporary name and renamed, so that concurrent runs only ever see complete entries
+        entry = os.path.join(self.cache_dir, stage.name, key)
+        tmp_entry = f"{entry}.{os.getpid()}.tmp"
+        os.makedirs(tmp_entry, exist_ok=True)
+        for i, path in enumerate(outputs):
+            link_or_copy(path, os.path.join(tmp_entry, str(i)))
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError: # Cached by a concurrent run in the meantime
+            shutil.rmtree(tmp_entry)
+
+    def prune(self, max_age_days, now=None):
+        """Removes the entries not used in the max_age_days before now (default the current time), and leftover
+        temporary entries as old"""
+        cutoff = (now or time.time()) - max_age_days * 86400
+        n_removed = 0
+        for stage in os.listdir(self.cache_dir):
+            stage_dir = os.path.join(self.cache_dir, stage)
+            if not os.path.isdir(stage_dir):
+                continue
+            for key in os.listdir(stage_dir):
+                entry = os.path.join(stage_dir, key)
+                if os.path.getmtime(entry) < cutoff:
+                    shutil.rmtree(entry, ignore_errors=True)
+                    n_removed += 1
+        # Forget the hashes of files that no longer exist
+        self.hashes = {path: stamp for path, stamp in self.hashes.items() if os.path.exists(path)}
+        print(f">>> Pruned {n_removed} cache entries unused for {max_age_days:g} days from {self.cache_dir}")
+
+    def save_hashes(self):
+        tmp_file = f"{self.hash_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(self.hashes, f)
+        os.replace(tmp_file, self.hash_file)
+
+
+def link_or_copy(src, dst):
+    # Stages write new files rather than modify their inputs, so cache entries can share them as hard links
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def run_stage(stage, variables, threads):
+    """Runs the stage script with bash, logging its output to <work>/<stage>.log. Returns (elapsed seconds, exit code)"""
+    env = dict(os.environ, **variables, threads=str(threads))
+    # Keep BLAS/OpenMP inside the stage's share of the thread budget
+    for var in ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]:
+        env[var] = str(threads)
+    start = time.perf_counter()
+    with open(os.path.join(variables['work'], f"{stage.name}.log"), 'w') as log:
+        proc = subprocess.run(["bash", "-c", "set -e\n" + stage.script], env=env, stdout=log, stderr=subprocess.STDOUT)
+    return time.perf_counter() - start, proc.returncode
+
+
+def run_stages(stages, variables, n_threads, cache=None, force=()):
+    """Runs the stages as a dependency graph: a stage starts as soon as its dependencies have finished and
+    threads are free. Each ready stage is granted at least one thread; stages that can use more get what is
+    left after one thread is set aside for every other ready stage. With a StageCache, stages whose inputs
+    are unchanged since a cached run are restored instead of run, unless named in force ('all' forces every
+    stage). Returns {stage: (start, elapsed, threads, status)}"""
+    check_stages(stages)
+    by_name = {s.name: s for s in stages}
+    pending = list(stages)
+    done, running, timings, keys = set(), {}, {}, {}
+    free = n_threads
+    failed = None
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(stages)) as pool:
+        while running or (pending and failed is None):
+            ready = [s for s in pending if set(s.deps) <= done] if failed is None else []
+            if cache is not None:
+                restored = False
+                for stage in ready:
+                    if stage.name not in keys:
+                        dep_outputs = [p for d in stage.deps for p in expand(by_name[d].outputs, variables)]
+                        keys[stage.name] = cache.key(stage, variables, [keys[d] for d in stage.deps], dep_outputs)
+                    if stage.name in force or 'all' in force or not cache.restore(stage, keys[stage.name], variables):
+                        continue
+                    pending.remove(stage)
+                    done.add(stage.name)
+                    timings[stage.name] = (time.perf_counter() - t0, 0.0, 0, 'cached')
+                    print(f">>> Restored {stage.name} from cache", flush=True)
+                    restored = True
+                if restored: # Stages depending on the restored ones may be ready now
+                    continue
+
+            for i, stage in enumerate(ready):
+                if free < 1 and running:
+                    break
+                cap = n_threads if stage.max_threads is None else stage.max_threads
+                threads = max(1, min(cap, free - (len(ready) - i - 1)))
+                free -= threads
+                pending.remove(stage)
+                # Outputs left by earlier runs may be hard links into the cache; never write through them
+                for path in expand(stage.outputs, variables):
+                    if os.path.lexists(path):
+                        os.remove(path)
+                print(f">>> Starting {stage.name} ({threads} thread{'s' if threads > 1 else ''})", flush=True)
+                running[pool.submit(run_stage, stage, variables, threads)] = (stage, threads, time.perf_counter() - t0)
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, threads, start = running.pop(future)
+                elapsed, returncode = future.result()
+                free += threads
+                timings[stage.name] = (start, elapsed, threads, 'ok' if returncode == 0 else 'failed')
+                if returncode == 0:
+                    done.add(stage.name)
+                    if cache is not None:
+                        cache.store(stage, keys[stage.name], variables)
+                    print(f">>> Finished {stage.name} in {elapsed:.1f}s", flush=True)
+                else:
+                    failed = failed or stage.name
+                    print(f">>> {stage.name} failed with exit code {returncode}, "
+                          f"see {os.path.join(variables['work'], stage.name + '.log')}", flush=True)
+    if cache is not None:
+        cache.save_hashes()
+    if failed is not None:
+        raise RuntimeError(f"Stage {failed} failed")
+    return timings
+
+
+def critical_path(stages, timings):
+    """Longest chain of dependent stages by measured time, as (total seconds, stage names)"""
+    paths = {}
+    for stage in stages:
+        before = max((paths[d] for d in stage.deps), default=(0.0, []))
+        paths[stage.name] = (before[0] + timings[stage.name][1], before[1] + [stage.name])
+    return max(paths.values())
+
+
+def report_timings(stages, timings, wall):
+    print(f"\n{'Stage':<16}{'Threads':>8}{'Start':>10}{'Time':>10}  Status")
+    for stage in stages:
+        start, elapsed, threads, status = timings[stage.name]
+        print(f"{stage.name:<16}{threads:>8}{start:>9.1f}s{elapsed:>9.1f}s  {status}")
+    path_time, path = critical_path(stages, timings)
+    print(f"Wall time {wall:.1f}s | Sum of stages {sum(t[1] for t in timings.values()):.1f}s | "
+          f"Critical path {path_time:.1f}s ({' > '.join(path)})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Computes BD-MitoPRS scores for a PLINK binary dataset")
+    parser.add_argument('target', help='Target PLINK binary file prefix')
+    parser.add_argument('outpre', help='Output prefix; scores are written to output/<outpre>_predictions.csv')
+    parser.add_argument('--scratch', default=os.environ.get('MITOPRS_SCRATCH', 'work'),
+                        help='Directory under which each run creates its own working directory. Default is ./work')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('MITOPRS_THREADS', os.cpu_count())),
+                        help='Number of threads shared by concurrently running stages. Default is all CPUs')
+    parser.add_argument('--cache-dir', default=os.environ.get('MITOPRS_CACHE'),
+                        help='Directory of cached stage outputs. Default is <scratch>/cache')
+    parser.add_argument('--no-cache', action='store_true', help='Run every stage without reading or writing the cache')
+    parser.add_argument('--prune-cache', type=float, metavar='DAYS', default=os.environ.get('MITOPRS_CACHE_MAX_AGE'),
+                        help='After the run, remove cache entries no run has used for this many days (0 keeps only '
+                             'the entries of this run). The cache is never pruned by default')
+    parser.add_argument('--force-stage', action='append', default=[], choices=[s.name for s in MITOPRS_STAGES] + ['all'],
+                        help='Rerun this stage even if its cached outputs are up to date; may be repeated')
+    parser.add_argument('--keep-work', action='store_true', default=os.environ.get('MITOPRS_KEEP_WORK') == '1',
+                        help='Keep the working directory after a successful run')
+    args = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    os.environ['PATH'] += ''.join(os.pathsep + os.path.expanduser(p) for p in PLINK_PATHS)
+    os.makedirs(args.scratch, exist_ok=True)
+    work = tempfile.mkdtemp(prefix=f"{args.outpre}.", dir=args.scratch)
+    print(f"Working directory: {work}")
+    variables = {'target': args.target, 'outpre': args.outpre, 'work': work, 'tname': os.path.basename(args.target)}
+
+    cache = None
+    if not args.no_cache:
+        cache = StageCache(args.cache_dir or os.path.join(args.scratch, 'cache'))
+
+    t0, run_start = time.perf_counter(), time.time()
+    try:
+        timings = run_stages(MITOPRS_STAGES, variables, max(1, args.threads), cache, args.force_stage)
+    except RuntimeError as e:
+        sys.exit(f"{e}; intermediate files are kept in {work}")
+    report_timings(MITOPRS_STAGES, timings, time.perf_counter() - t0)
+    if cache is not None and args.prune_cache is not None:
+        cache.prune(args.prune_cache, run_start)
+        cache.save_hashes()
+
+    #Final Cleanup
+    if not args.keep_work:
+        shutil.rmtree(work)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,77 +9,12 @@ from sklearn.preprocessing import OneHotEncoder, StandardScaler
 from sklearn.model_selection import RandomizedSearchCV, train_test_split, PredefinedSplit
 from scipy.stats import uniform, randint, loguniform
 from sklearn.linear_model import LogisticRegression
-from sklearn.model_selection import RandomizedSearchCV
-
-def load_data_split(feat_path, cov_path, name_path, label_path):
-    """Loads a specific split independently using memory-efficient dtypes."""
-    names_df = pd.read_csv(name_path, sep=r'\s+', header = None, engine = 'python')
-    feature_names = names_df.iloc[0].values.tolist()
-    X_main = pd.read_csv(feat_path, sep='\t', header=None,
-                         engine='c', low_memory=False, memory_map=True, na_values=['-9','NA', '3'])
-    X_main = X_main.copy()
-
-    print(f"Checking shapes of loaded data: {X_main.shape}, feature length: {len(feature_names)}")
-
-    print(f"Data loaded with shape: {X_main.shape}")
-    if len(feature_names) == X_main.shape[1]:
-        X_main.columns = feature_names
-    else:
-        print(f"Warning: Name count ({len(feature_names)}) does not match. Column count ({X_main.shape[1]}).")
-        
-    cov_df = pd.read_csv(cov_path, sep='\t').iloc[:, 2:]
-    cov_names = [f"Covariate{i+1}" for i in range(cov_df.shape[1])]
-    cov_df.columns = cov_names
-
-    label_df = pd.read_csv(label_path, sep='\t', header=None)
-    print(label_df.shape)
-    print(X_main.shape)
-
-    # Binary encoding: 2 is 1 (Case), 1 is 0 (Control)
-    sex = (label_df.iloc[:, 4] == 2).astype(np.int8)
-    sex.name = 'sex'
-    y = (label_df.iloc[:, 5] == 2).astype(np.int8)
-    id_df = label_df.iloc[:, 0:2]
-
-    X_main.reset_index(drop=True, inplace=True)
-    cov_df.reset_index(drop=True, inplace=True)
-
-    X = pd.concat([X_main, cov_df, sex.reset_index(drop = True)], axis=1)
-    X = X.copy()
-    
-    print(np.isinf(X).sum().sum())
-    print(f"Final dimension of dataset {X.shape}")
-    print(f"Label breakdown: {np.unique(y, return_counts=True)}")
-
-    # --- Feature Matrix Integrity Check ---
-    print("\n[Integrity Check] Checking Feature Matrix X...")
-
-# 1. Check for NaNs
-    nan_count = X.isna().sum().sum()
-    if nan_count > 0:
-        print(f"⚠️  WARNING: Found {nan_count} NaN values. XGBoost will handle them, but ensure this is expected.")
-
-# 2. Check for Infinite values (The likely cause of NaN scores)
-    inf_count = np.isinf(X.values).sum()
-    if inf_count > 0:
-        print(f"❌ CRITICAL: Found {inf_count} infinite values! Replacing with NaNs...")
-        X = X.replace([np.inf, -np.inf], np.nan)
-
-# 3. Check for Constant Columns (Zero Variance)
-# These columns provide no information and can sometimes slow down training
-    constant_cols = [col for col in X.columns if X[col].nunique() <= 1]
-    if len(constant_cols) > 0:
-        print(f"ℹ️  Note: Found {len(constant_cols)} columns with zero variance (constant values).")
-
-    print(f"[Integrity Check] Final Matrix Shape: {X.shape}\n")
-    
-    full_names = X.columns.tolist()
-
-    del X_main
-    del cov_df
-    gc.collect()
-
-    return X, y, full_names, id_df
+from sklearn.model_selection import RandomizedSearchCV, StratifiedKFold
+from sklearn.metrics import roc_auc_score
+from scipy.special import expit
+# Data loading lives in the lightweight mitoprs_data, which scoring imports without sklearn or xgboost
+from mitoprs_data import (peak_memory_gb, check_features, read_split_parts, assemble_features, load_data_split,
+                          iter_data_chunks, genotype_medians)
 
 class InformedElasticNet(LogisticRegression):
     def __init__(self, C=1.0, l1_ratio=0.5, max_iter=3000, tol=0.01, betas=None):
@@ -101,7 +36,7 @@ class InformedElasticNet(LogisticRegression):
         # In this case, the ENET coverges faster, and higher tolerance can be used for speeding up training without sacrificing much performance.
         # 1. Initialize internal state (fitting on random 1000 samples to set up the coefficient structure)
         rng = np.random.default_rng(seed=42)
-        idx = rng.choice(25000, size = 1000, replace = False)
+        idx = rng.choice(len(y), size = min(1000, len(y)), replace = False)
         X_init = X.iloc[idx] if hasattr(X, 'iloc') else X[idx]
         y_init = y.iloc[idx] if hasattr(y, 'iloc') else y[idx]
         print(f"Fitting Initial Subset to set coefficients")
@@ -114,6 +49,80 @@ class InformedElasticNet(LogisticRegression):
         # 3. Resume training on full data
         return super().fit(X, y)
 
+    def fit_path(self, X, y, Cs, l1_ratios=None, cv=5, seed=42):
+        # Training mode replacing a search over independent fits: for each l1_ratio the whole C path is fitted from the strongest penalty up,
+        # each fit warm-started from the previous solution and restricted to the variants the sequential strong rule keeps, with a KKT
+        # check adding back any variant it wrongly discarded. The (C, l1_ratio) with the best mean validation AUC over the cv folds is
+        # then refitted on all samples, and the model is set to it. X is used as given (float32 is not copied to float64).
+        X = np.asarray(X)
+        y = np.asarray(y, dtype=np.float64)
+        Cs = np.sort(np.asarray(Cs, dtype=np.float64))
+        l1_ratios = [self.l1_ratio] if l1_ratios is None else l1_ratios
+        folds = list(StratifiedKFold(cv, shuffle=True, random_state=seed).split(np.zeros(len(y)), y))
+
+        self.path_scores_ = pd.DataFrame(np.nan, index=pd.Index(Cs, name='C'), columns=pd.Index(l1_ratios, name='l1_ratio'))
+        for l1_ratio in l1_ratios:
+            fold_scores = np.zeros((cv, len(Cs)))
+            for k, (train, val) in enumerate(folds):
+                for i, (C, coef, intercept) in enumerate(self._path(X, y, train, Cs, l1_ratio)):
+                    nz = np.flatnonzero(coef)
+                    fold_scores[k, i] = roc_auc_score(y[val], X[np.ix_(val, nz)] @ coef[nz] + intercept)
+                print(f"l1_ratio {l1_ratio}, fold {k + 1}/{cv}: best validation AUC {fold_scores[k].max():.4f}")
+            self.path_scores_[l1_ratio] = fold_scores.mean(axis=0)
+
+        best_C, best_l1_ratio = self.path_scores_.stack().idxmax()
+        print(f"Best C {best_C:g}, l1_ratio {best_l1_ratio:g}: mean validation AUC {self.path_scores_.loc[best_C, best_l1_ratio]:.4f}")
+        for C, coef, intercept in self._path(X, y, np.arange(len(y)), Cs[Cs <= best_C], best_l1_ratio):
+            pass
+        self.set_params(C=best_C, l1_ratio=best_l1_ratio)
+        self.classes_ = np.array([0, 1])
+        self.coef_ = coef[np.newaxis, :]
+        self.intercept_ = np.array([intercept])
+        self.n_features_in_ = X.shape[1]
+        return self
+
+    def _path(self, X, y, rows, Cs, l1_ratio):
+        # Yields (C, coef, intercept) fitted on the given rows, for Cs in increasing order. The betas, if given, only warm-start the first fit:
+        # its columns are screened from the intercept-only model like every later fit is from the previous solution.
+        # In sklearn's scaling a zero coefficient is optimal while |x_j' (y - p)| <= l1_ratio / C; variants with a non-zero coefficient are always kept.
+        coef = np.zeros(X.shape[1])
+        warm = coef if self.betas is None else np.ravel(self.betas).astype(np.float64)
+        intercept = np.log(y[rows].mean() / (1 - y[rows].mean()))
+        grad = self._gradient(X, y, rows, coef, intercept)
+        # The path starts from lambda_max, the smallest penalty at which every coefficient is zero
+        lam_prev = np.abs(grad).max() / l1_ratio
+        for C in Cs:
+            lam = 1 / C
+            keep = (coef != 0) | (np.abs(grad) >= l1_ratio * (2 * lam - lam_prev))
+            while True:
+                cols = np.flatnonzero(keep)
+                coef = np.zeros(X.shape[1])
+                if len(cols):
+                    model = LogisticRegression(penalty='elasticnet', solver='saga', C=C, l1_ratio=l1_ratio,
+                                               max_iter=self.max_iter, tol=self.tol, warm_start=True)
+                    model.coef_, model.intercept_ = warm[np.newaxis, cols], np.array([intercept])
+                    model.fit(X[np.ix_(rows, cols)], y[rows])
+                    coef[cols], intercept = model.coef_[0], model.intercept_[0]
+                if not coef.any():
+                    # No variant fitted or entered (as above lambda_max): the optimal intercept is the log-odds of the cases
+                    intercept = np.log(y[rows].mean() / (1 - y[rows].mean()))
+                warm = coef
+                grad = self._gradient(X, y, rows, coef, intercept)
+                violations = ~keep & (np.abs(grad) > l1_ratio * lam)
+                if not violations.any():
+                    break
+                keep |= violations
+            lam_prev = lam
+            yield C, coef, intercept
+
+    @staticmethod
+    def _gradient(X, y, rows, coef, intercept):
+        # x_j' (y - p) over the given rows for every column; residuals outside them are zero, so X is read in place and never copied
+        nz = np.flatnonzero(coef)
+        resid = np.zeros(X.shape[0], dtype=X.dtype)
+        resid[rows] = y[rows] - expit(X[np.ix_(rows, nz)] @ coef[nz] + intercept)
+        return X.T @ resid
+
 
 
 
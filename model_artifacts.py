@@ -0,0 +1,218 @@
+import argparse
+import copy
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Pickled models as trained, and the native artifacts exported from them
+XGB_PATH = "model/0.15_xgb_model.pkl"
+ENET_PATH = "model/0.3_enet_model.pkl"
+# Genotype columns the models were trained on, followed in their inputs by the covariates and sex
+XGB_VARIDS = "ref/xgb_varids.txt"
+ENET_VARIDS = "ref/enet_varids.txt"
+
+
+def artifact_paths(xgb_path=XGB_PATH, enet_path=ENET_PATH):
+    return os.path.splitext(xgb_path)[0] + '.ubj', os.path.splitext(enet_path)[0] + '.npz'
+
+
+def used_varids_path(xgb_path=XGB_PATH):
+    """Variants the XGBoost trees split on, written by the export; the only XGBoost genotypes worth extracting"""
+    return os.path.splitext(xgb_path)[0] + '.used_varids.txt'
+
+
+def active_varids_path(enet_path=ENET_PATH):
+    """Variants with a non-zero ENet coefficient, written by the export; the only ENet genotypes worth extracting"""
+    return os.path.splitext(enet_path)[0] + '.active_varids.txt'
+
+
+class XGBScorer:
+    """XGBoost booster loaded from its native format; predict_proba as XGBClassifier for binary:logistic.
+    Inputs are float32 arrays in the booster's feature order, predicted in place without a DMatrix"""
+
+    def __init__(self, path, n_threads=None):
+        import xgboost as xgb
+        self.booster = xgb.Booster(model_file=path)
+        if n_threads:
+            self.booster.set_param({'nthread': n_threads})
+        self.iteration_range = self.iteration_range_of(self.booster)
+        self.columns = None
+
+    @staticmethod
+    def iteration_range_of(booster):
+        # XGBClassifier only uses the trees up to the best iteration of early stopping
+        best_iteration = booster.attr('best_iteration')
+        return (0, int(best_iteration) + 1) if best_iteration is not None else (0, 0)
+
+    def for_columns(self, names):
+        """Scorer for inputs with the given columns, of which it reads the booster's features by name. Boosters
+        without feature names take their inputs in order"""
+        if self.booster.feature_names is None:
+            return self
+        cols = pd.Index(names).get_indexer(self.booster.feature_names)
+        if (cols < 0).any():
+            raise ValueError(f"{(cols < 0).sum()} XGBoost features are missing from the input columns")
+        scorer = copy.copy(self)
+        # Inputs holding exactly the booster's features, in order, are passed on as they are
+        scorer.columns = None if np.array_equal(cols, np.arange(len(names))) else cols
+        return scorer
+
+    def predict_proba(self, X, block_size=4096):
+        if self.columns is None:
+            p = self._predict(np.asarray(X, dtype=np.float32))
+        else:
+            # The booster's columns are gathered a block of rows at a time, never copying the whole matrix
+            X = np.asarray(X)
+            p = np.concatenate([self._predict(X[start:start + block_size, self.columns].astype(np.float32, copy=False))
+                                for start in range(0, max(X.shape[0], 1), block_size)])
+        return np.column_stack([1 - p, p])
+
+    def _predict(self, X):
+        return self.booster.inplace_predict(X, iteration_range=self.iteration_range, missing=np.nan)
+
+
+def prune_booster(booster, iteration_range):
+    """Booster with only the trees in iteration_range, taking as input only the features those trees split on
+    (in their original order). Predictions on those columns are the original booster's on all of them"""
+    import xgboost as xgb
+    if iteration_range[1]:
+        booster = booster[iteration_range[0]:iteration_range[1]]
+    model = json.loads(booster.save_raw('json'))
+    learner = model['learner']
+    trees = learner['gradient_booster']['model']['trees']
+    # Leaves (no children) carry a placeholder split index
+    splits = [np.asarray(t['left_children']) != -1 for t in trees]
+    used = np.unique(np.concatenate([np.asarray(t['split_indices'])[s] for t, s in zip(trees, splits)]))
+    for tree, is_split in zip(trees, splits):
+        tree['split_indices'] = np.where(is_split, np.searchsorted(used, tree['split_indices']), 0).tolist()
+        tree['tree_param']['num_feature'] = str(len(used))
+    learner['learner_model_param']['num_feature'] = str(len(used))
+    for key in ['feature_names', 'feature_types']:
+        if learner.get(key):
+            learner[key] = [learner[key][i] for i in used]
+    pruned = xgb.Booster()
+    pruned.load_model(bytearray(json.dumps(model).encode()))
+    return pruned
+
+
+class ENetScorer:
+    """Logistic model from flat coefficient and intercept arrays; predict_proba as sklearn LogisticRegression.
+    The coefficients cover the genotypes in varids order, then the covariates and sex"""
+
+    def __init__(self, path=None, coef=None, intercept=None, varids=None):
+        if path is not None:
+            with np.load(path, allow_pickle=False) as f:
+                coef, intercept, varids = f['coef'], f['intercept'], f['varids']
+        self.coef = coef
+        self.intercept = intercept
+        self.varids = varids
+        self.nonzero = np.flatnonzero(coef)
+
+    def for_columns(self, names):
+        """Scorer for inputs with the given columns: genotypes named <id>_<allele> as feature_matrix.py names them,
+        followed by the covariates and sex. Columns may be any subset of the genotypes, such as the active ones"""
+        n_other = len(self.coef) - len(self.varids)
+        ids = [str(n).rsplit('_', 1)[0] for n in names[:len(names) - n_other]]
+        rows = pd.Index(self.varids).get_indexer(ids)
+        if (rows < 0).any():
+            raise ValueError(f"{(rows < 0).sum()} ENet input columns are not among the model variants")
+        cols = np.concatenate([rows, np.arange(len(self.varids), len(self.coef))])
+        return ENetScorer(coef=self.coef[cols], intercept=self.intercept, varids=self.varids[rows])
+
+    def predict_proba(self, X):
+        from scipy.special import expit
+        X = np.asarray(X)
+        # Computed in the input precision, as sklearn does for float32 inputs
+        dtype = X.dtype if X.dtype in (np.float32, np.float64) else np.dtype(np.float64)
+        coef = self.coef.astype(dtype)
+        if len(self.nonzero) < len(coef):
+            # Only the columns with non-zero coefficients contribute
+            z = X[:, self.nonzero] @ coef[self.nonzero]
+        else:
+            z = X @ coef
+        p = expit(z + dtype.type(self.intercept))
+        return np.column_stack([1 - p, p])
+
+
+def load_models(xgb_path=XGB_PATH, enet_path=ENET_PATH, n_threads=None):
+    """Loads the exported artifacts, or the pickled models if they have not been exported yet"""
+    xgb_art, enet_art = artifact_paths(xgb_path, enet_path)
+    if os.path.exists(xgb_art) and os.path.exists(enet_art):
+        return XGBScorer(xgb_art, n_threads), ENetScorer(enet_art)
+    print(f"Warning: {xgb_art} or {enet_art} not found, loading the pickled models "
+          f"(python model_artifacts.py exports them)")
+    return load_pickles(xgb_path, enet_path)
+
+
+def load_pickles(xgb_path=XGB_PATH, enet_path=ENET_PATH):
+    import joblib
+    import mitoprs_utils
+    # The ENet pickle refers to InformedElasticNet by the module name it was trained under
+    sys.modules['enet_utils'] = mitoprs_utils
+    return joblib.load(xgb_path), joblib.load(enet_path)
+
+
+def export_models(xgb_path=XGB_PATH, enet_path=ENET_PATH, xgb_varids=XGB_VARIDS, enet_varids=ENET_VARIDS,
+                  n_check=256, seed=42):
+    """Saves the XGBoost booster, pruned to the trees and features it predicts with, as UBJSON and the ENet
+    coefficients, intercept and genotype ids as .npz next to the pickles, with the ids of the variants each
+    model uses. Then checks that both artifacts give the pickled models' probabilities on random genotype
+    inputs: exactly for the XGBoost, up to float32 rounding for the ENet"""
+    xgb_model, enet_model = load_pickles(xgb_path, enet_path)
+    xgb_art, enet_art = artifact_paths(xgb_path, enet_path)
+
+    booster = xgb_model.get_booster()
+    xgb_ids = pd.read_csv(xgb_varids, sep=r"\s+", header=None, usecols=[0], dtype=str)[0]
+    if booster.feature_names is None:
+        # Without names the inputs cannot be matched to a subset of the features, so every variant is kept
+        print(f"Warning: {xgb_path} has no feature names, exporting it unpruned")
+        booster.save_model(xgb_art)
+        used = xgb_ids
+    else:
+        pruned = prune_booster(booster, XGBScorer.iteration_range_of(booster))
+        pruned.save_model(xgb_art)
+        used_names = set(pruned.feature_names)
+        used = xgb_ids[[name in used_names for name in booster.feature_names[:len(xgb_ids)]]]
+    used.to_csv(used_varids_path(xgb_path), index=False, header=False)
+    print(f"Exported {xgb_art}; the trees split on {len(used)} of {len(xgb_ids)} XGBoost variants")
+    if len(enet_model.classes_) != 2:
+        raise ValueError(f"{enet_path} is not a binary classifier")
+    coef = enet_model.coef_.ravel().astype(np.float64)
+    varids = pd.read_csv(enet_varids, sep=r"\s+", header=None, usecols=[0], dtype=str)[0].to_numpy()
+    if len(varids) >= len(coef):
+        raise ValueError(f"{enet_path} has {len(coef)} coefficients, too few for the {len(varids)} variants in {enet_varids}")
+    np.savez(enet_art, coef=coef, intercept=np.float64(enet_model.intercept_[0]), varids=varids.astype(str))
+    active = varids[coef[:len(varids)] != 0]
+    pd.Series(active).to_csv(active_varids_path(enet_path), index=False, header=False)
+    print(f"Exported {enet_art}; {len(active)} of {len(varids)} ENet variants have non-zero coefficients")
+
+    rng = np.random.default_rng(seed)
+    xgb_scorer, enet_scorer = XGBScorer(xgb_art), ENetScorer(enet_art)
+    if booster.feature_names is not None:
+        xgb_scorer = xgb_scorer.for_columns(booster.feature_names)
+    for name, model, scorer, tol in [('XGB', xgb_model, xgb_scorer, 0), ('ENet', enet_model, enet_scorer, 1e-6)]:
+        X = rng.integers(0, 3, (n_check, model.n_features_in_)).astype(np.float32)
+        X[rng.random(X.shape) < 0.05] = np.nan
+        if name == 'ENet':
+            X = np.nan_to_num(X) # ENet inputs are imputed before prediction
+        diff = np.abs(model.predict_proba(X)[:, 1] - scorer.predict_proba(X)[:, 1]).max()
+        print(f"{name}: max probability difference to the pickled model {diff:.2e}")
+        if diff > tol:
+            raise ValueError(f"Exported {name} model does not reproduce the pickled model")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exports the pickled models as native XGBoost and flat ENet artifacts")
+    parser.add_argument('--xgb', default=XGB_PATH)
+    parser.add_argument('--enet', default=ENET_PATH)
+    parser.add_argument('--xgb-varids', default=XGB_VARIDS, help='Genotype ids of the XGBoost input columns, in order')
+    parser.add_argument('--enet-varids', default=ENET_VARIDS, help='Genotype ids of the ENet input columns, in order')
+    args = parser.parse_args()
+    export_models(args.xgb, args.enet, args.xgb_varids, args.enet_varids)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from FRAPOSA.bed import MISSING, Bed
+
+
+def read_score_file(path, id_col, allele_col, score_cols):
+    """Reads a PLINK --score file (whitespace-delimited, 1-based column numbers). Rows whose scores are not
+    numeric, such as a header line, are skipped like PLINK skips unmatched variant ids"""
+    cols = [id_col - 1, allele_col - 1] + [c - 1 for c in score_cols]
+    df = pd.read_csv(path, sep=r"\s+", header=None, usecols=cols, dtype=str)
+    weights = df[[c - 1 for c in score_cols]].apply(pd.to_numeric, errors='coerce')
+    is_valid = weights.notna().all(axis=1).to_numpy()
+    return (df[id_col - 1].to_numpy()[is_valid], df[allele_col - 1].str.upper().to_numpy()[is_valid],
+            weights.to_numpy(dtype=np.float64)[is_valid])
+
+
+def score_matrix(bim, score_sets):
+    """Matches score files to the .bim by variant id and scored allele. score_sets holds (path, id_col, allele_col,
+    score_cols) tuples. Returns the scored .bim rows, the (rows x scores) sparse weight matrix, the dense
+    (rows x scores) dosage of the scored allele at genotype code 0 (2 for A1, 0 for A2, nan where a variant is
+    not part of a score) and the score labels"""
+    rows, cols, weights, is_a1, labels = [], [], [], [], []
+    ids = pd.Index(bim['id']).drop_duplicates()
+    a1 = bim['a1'].astype(str).str.upper().to_numpy()
+    a2 = bim['a2'].astype(str).str.upper().to_numpy()
+    for path, id_col, allele_col, score_cols in score_sets:
+        var_ids, alleles, w = read_score_file(path, id_col, allele_col, score_cols)
+        row = ids.get_indexer(var_ids)
+        found = row >= 0
+        on_a1 = found & (a1[np.where(found, row, 0)] == alleles)
+        on_a2 = found & ~on_a1 & (a2[np.where(found, row, 0)] == alleles)
+        matched = on_a1 | on_a2
+        print(f"{path}: {matched.sum()} of {len(var_ids)} variants scored ({(~found).sum()} not found, "
+              f"{(found & ~matched).sum()} with the scored allele absent)")
+        stem = os.path.basename(path)
+        for k, score_col in enumerate(score_cols):
+            rows.append(row[matched])
+            cols.append(np.full(matched.sum(), len(labels)))
+            weights.append(w[matched, k])
+            is_a1.append(on_a1[matched])
+            label = stem if len(score_cols) == 1 else f"{stem}_{score_col}"
+            labels.append(label if label not in labels else f"{label}_{len(labels) + 1}")
+
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    scored, rows = np.unique(rows, return_inverse=True)
+    W = sparse.csr_matrix((np.concatenate(weights), (rows, cols)), shape=(len(scored), len(labels)))
+    # Per score, as a variant may be scored on A1 in one set and on A2 in another
+    base = np.full(W.shape, np.nan)
+    base[rows, cols] = np.where(np.concatenate(is_a1), 2.0, 0.0)
+    return scored, W, base, labels
+
+
+def read_plink(bfile):
+    bim = pd.read_csv(f"{bfile}.bim", sep=r"\s+", header=None, usecols=[1, 4, 5], names=['id', 'a1', 'a2'], dtype=str)
+    fam = pd.read_csv(f"{bfile}.fam", sep=r"\s+", header=None, usecols=[0, 1, 5], names=['FID', 'IID', 'PHENO'], dtype=str)
+    return bim, fam, Bed(bfile, n_variants=len(bim), n_samples=len(fam))
+
+
+def accumulate(bed, scored, W, base, block_size=4096):
+    """Weighted allele dosage sums of every sample for each score, in a single pass over the scored .bed rows.
+    Missing genotypes are imputed with the scored allele frequency among the samples; variants without any
+    observed genotype do not contribute. Returns (scores x samples) arrays of the dosage sums, of the non-missing
+    allele counts (CNT) and of the scored allele counts (CNT2), and the number of contributing variants per score"""
+    n_scores = W.shape[1]
+    total, cnt, cnt2 = (np.zeros((n_scores, bed.n_samples)) for _ in range(3))
+    n_variants = np.zeros(n_scores, dtype=np.int64)
+    for start in range(0, len(scored), block_size):
+        stop = min(start + block_size, len(scored))
+        geno = bed.read(scored[start:stop])
+        observed = (geno != MISSING).astype(np.float64)
+        codes = np.where(geno == MISSING, 0, geno).astype(np.float64)
+        n_obs = observed.sum(axis=1, keepdims=True)
+        mean_code = codes.sum(axis=1, keepdims=True) / np.maximum(n_obs, 1)
+
+        # Dosage of the scored allele is base + sign * code; missing genotypes get the mean dosage
+        member = ~np.isnan(base[start:stop])
+        base_b = np.where(member, base[start:stop], 0)
+        sign = np.where(member, 1 - base_b, 0)
+        mean_dosage = np.where(n_obs > 0, base_b + sign * mean_code, 0)
+        W_b = W[start:stop]
+        W_mean = W_b.multiply(mean_dosage)
+        # sum_j w_j * (mean_j + observed_j * (base_j - mean_j) + sign_j * code_j)
+        total += (np.asarray(W_mean.sum(axis=0)).T + (W_b.multiply(base_b) - W_mean).T @ observed
+                  + W_b.multiply(sign).T @ codes)
+        cnt += 2 * (member.T.astype(np.float64) @ observed)
+        cnt2 += base_b.T @ observed + sign.T @ codes
+        n_variants += (member & (n_obs > 0)).sum(axis=0)
+    return total, cnt, cnt2, n_variants
+
+
+def score(bfile, score_sets, block_size=4096):
+    """Scores every sample on all score sets in a single pass over the .bed, like PLINK 1.9 --score defaults:
+    missing genotypes are mean-imputed (see accumulate) and SCORE is the sum of allele dosage x weight divided
+    by CNT, the number of non-missing alleles. Returns a DataFrame with FID, IID, PHENO and CNT, CNT2, SCORE per
+    score set"""
+    bim, fam, bed = read_plink(bfile)
+    scored, W, base, labels = score_matrix(bim, score_sets)
+    total, cnt, cnt2, _ = accumulate(bed, scored, W, base, block_size)
+
+    out = fam.copy()
+    for k, label in enumerate(labels):
+        suffix = '' if len(labels) == 1 else f"_{label}"
+        out[f"CNT{suffix}"] = cnt[k].astype(np.int64)
+        out[f"CNT2{suffix}"] = cnt2[k].astype(np.int64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out[f"SCORE{suffix}"] = total[k] / cnt[k]
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Polygenic scores from PLINK binary files, as plink --score")
+    parser.add_argument('--bfile', required=True)
+    parser.add_argument('--score', required=True, action='append', nargs='+', metavar='FILE ID_COL ALLELE_COL SCORE_COL',
+                        help='Score file and 1-based columns of the variant id, scored allele and one or more scores; '
+                             'may be repeated. All score sets are computed in one pass over the genotypes')
+    parser.add_argument('--block-size', type=int, default=4096, help='Variants decoded at a time')
+    parser.add_argument('--out', required=True, help='Scores are written to <out>.profile')
+    args = parser.parse_args()
+
+    score_sets = []
+    for spec in args.score:
+        if len(spec) < 4:
+            parser.error('--score needs a file, an id column, an allele column and at least one score column')
+        score_sets.append((spec[0], int(spec[1]), int(spec[2]), [int(c) for c in spec[3:]]))
+    profile = score(args.bfile, score_sets, args.block_size)
+    profile.to_csv(f"{args.out}.profile", sep=' ', index=False, float_format='%.6g')
+    print(f"Scores for {len(profile)} samples written to {args.out}.profile")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+#!/bin/bash
+
+## Input: $1-File with one target per line: TargetPrefix [OutputPrefix (default: basename of TargetPrefix)]
+##        $2-Number of cohorts scored concurrently (default: 2) [$3-ScratchDirectory, passed to run_mitoprs.sh]
+## Output: one BD-MitoPRS .csv per target in ./output, as written by run_mitoprs.sh
+
+export targets="$1"
+export n_jobs="${2:-2}"
+export scratch="$3"
+
+# Threads are split evenly between the concurrent cohorts unless MITOPRS_THREADS is set
+export MITOPRS_THREADS="${MITOPRS_THREADS:-$(( $(nproc) / n_jobs > 0 ? $(nproc) / n_jobs : 1 ))}"
+
+cd "$(dirname "$0")"
+mkdir -p logs
+
+# Each run gets its own work directory, so the runs only share the read-only reference files
+grep -v '^[[:space:]]*$' "$targets" | \
+    xargs -P "$n_jobs" -L 1 bash -c './run_mitoprs.sh "$0" "${1:-$(basename "$0")}" ${scratch:+"$scratch"} > "logs/${1:-$(basename "$0")}.log" 2>&1 && echo "Finished $0" || echo "FAILED $0 (see logs/${1:-$(basename "$0")}.log)"'
@@ -1,22 +1,12 @@
-import joblib
 import os
-import sys
-import xgboost as xgb
 import pandas as pd
 import numpy as np
-from sklearn.metrics import roc_auc_score
-import mitoprs_utils as utils
-sys.modules['enet_utils'] = utils
-# This import is vital: it provides load_data_split_median AND InformedElasticNet
-from mitoprs_utils import InformedElasticNet
-import sklearn
-sklearn.set_config(transform_output="pandas")
+# Data loading only: mitoprs_utils (sklearn, xgboost) is imported just for the pickled-model fallback
+import mitoprs_data as utils
+# Hardcoded model paths (model/0.15_xgb_model.pkl, model/0.3_enet_model.pkl); their exported .ubj/.npz are loaded if present
+from model_artifacts import XGB_PATH, ENET_PATH, ENetScorer, XGBScorer, load_models
 
 def main():
-    # Hardcoded paths as requested
-    XGB_PATH = "model/0.15_xgb_model.pkl"
-    ENET_PATH = "model/0.3_enet_model.pkl"
-    
     #Making output directory if doesn't exist
     output_dir = "./output"
     os.makedirs("output", exist_ok=True)
@@ -28,30 +18,44 @@ def main():
     parser.add_argument('--ext-label', required=True)
     parser.add_argument('--train-names', required=True)
     parser.add_argument('--out-prefix', required=True)
+    parser.add_argument('--work-dir', default='.', help='Directory holding the PRS-CSx/PRSice scores of this run')
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help='Predict in chunks of this many samples, appending each to the output (.npy features only)')
+    parser.add_argument('--enet-medians', default=None,
+                        help='Tab-delimited feature name and median per line, used to fill missing ENet inputs in '
+                             'chunked mode instead of the cohort medians')
+    parser.add_argument('--threads', type=int, default=None, help='XGBoost prediction threads. Default is all cores')
     args = parser.parse_args()
 
+    # Load Models
+    print(">>> Loading models from model/...")
+    xgb_model, enet_model = load_models(XGB_PATH, ENET_PATH, args.threads)
+
+    out_file = os.path.join(output_dir, f"{args.out_prefix}_predictions.csv")
+    if args.chunk_size:
+        # Before any full matrix is loaded, so memory is bounded by the chunk
+        predict_chunked(args, xgb_model, enet_model, out_file)
+        return
+
     # Load Data
     X_new, y_new, full_names, identifiers = utils.load_data_split(
-        f"{args.ext_feature}_xgb.geno", args.ext_cov, f"{args.train_names}_xgb.names", args.ext_label
+        f"{args.ext_feature}_xgb.npy", args.ext_cov, f"{args.train_names}_xgb.names", args.ext_label
     )
 
-    # Load Models
-    print(f">>> Loading models from /ref/...")
-    xgb_model = joblib.load(XGB_PATH)
-    enet_model = joblib.load(ENET_PATH)
-
     # Predict
     print(">>> Running predictions...")
-    # XGBoost
-    xgb_probs = xgb_model.predict_proba(X_new)[:, 1]
+    # XGBoost (the exported genotypes may be only the variants its trees split on)
+    xgb_probs = for_columns(xgb_model, full_names).predict_proba(X_new)[:, 1]
     
     del X_new, y_new, full_names, identifiers
 
     # Elastic Net (using np.float32 for input, filling NA with median of each column)
     X_new, y_new, full_names, identifiers = utils.load_data_split(
-        f"{args.ext_feature}_enet.geno", args.ext_cov, f"{args.train_names}_enet.names", args.ext_label
+        f"{args.ext_feature}_enet.npy", args.ext_cov, f"{args.train_names}_enet.names", args.ext_label
     )
     X_new.columns = full_names
+    # The exported genotypes may be only the variants with non-zero coefficients; the scorer is matched to them
+    enet_model = for_columns(enet_model, full_names)
     X_new = X_new.fillna(X_new.median())
     #If median filling still results in NA (e.g. when all values for a given variant is missing, replacing with REF 0/0 genotype)
     X_new = X_new.fillna(0)
@@ -66,17 +70,72 @@ def main():
     results['BD_mitoPRS_XGB'] = xgb_probs
     results['BD_mitoPRS_ENet'] = enet_probs
 
-    # Loading other scores for appending
-    csx_df = pd.read_csv(f"{args.out_prefix}.csx.profile", sep=r'\s+', usecols=['FID', 'IID', 'SCORE']).rename(columns={'SCORE': 'BD_mitoPRS_PRSCSx'})
-    ice_df = pd.read_csv(f"{args.out_prefix}.all_score", sep=r'\s+', usecols=['FID', 'IID', 'Pt_0.25']).rename(columns={'Pt_0.25': 'BD_mitoPRS_PRSice'})
-    pc_df = pd.read_csv(args.ext_cov, sep=r'\s+', usecols=['FID', 'IID', 'PC1', 'PC2', 'PC3', 'PC4', 'PC5'])
-
     # 7. Export
-    out_file = os.path.join(output_dir, f"{args.out_prefix}_predictions.csv")
-    results = results.merge(csx_df, on=['FID', 'IID'], how='left')
-    results = results.merge(ice_df, on=['FID', 'IID'], how='left')
-    results = results.merge(pc_df, on=['FID', 'IID'], how='left')
+    results = merge_other_scores(results, load_other_scores(args))
     results.to_csv(out_file, index=False)
+
+
+def load_other_scores(args):
+    # Loading other scores for appending
+    csx_df = pd.read_csv(os.path.join(args.work_dir, f"{args.out_prefix}.csx.profile"), sep=r'\s+', usecols=['FID', 'IID', 'SCORE']).rename(columns={'SCORE': 'BD_mitoPRS_PRSCSx'})
+    ice_df = pd.read_csv(os.path.join(args.work_dir, f"{args.out_prefix}.all_score"), sep=r'\s+', usecols=['FID', 'IID', 'Pt_0.25']).rename(columns={'Pt_0.25': 'BD_mitoPRS_PRSice'})
+    pc_df = pd.read_csv(args.ext_cov, sep=r'\s+', usecols=['FID', 'IID', 'PC1', 'PC2', 'PC3', 'PC4', 'PC5'])
+    return csx_df, ice_df, pc_df
+
+
+def merge_other_scores(results, other_scores):
+    for df in other_scores:
+        results = results.merge(df, on=['FID', 'IID'], how='left')
+    return results
+
+
+def for_columns(model, full_names):
+    return model.for_columns(full_names) if isinstance(model, (XGBScorer, ENetScorer)) else model
+
+
+def enet_fill_values(args, enet_path):
+    """Values filling missing ENet inputs: stored medians if given, else the cohort medians from one pass over the
+    genotypes (and the covariates), with 0 (REF/REF) where a median is undefined, as in the in-memory mode.
+    Returned with the ENet input column names"""
+    _, names, cov, cov_names, sex, _, _ = utils.read_split_parts(enet_path, args.ext_cov, f"{args.train_names}_enet.names", args.ext_label)
+    if args.enet_medians:
+        medians = pd.read_csv(args.enet_medians, sep='\t', header=None, index_col=0).iloc[:, 0]
+        medians = medians.reindex(names + cov_names + ['sex']).to_numpy(dtype=np.float64)
+    else:
+        print(">>> Computing ENet imputation medians...")
+        medians = np.concatenate([utils.genotype_medians(enet_path), np.nanmedian(cov, axis=0), [sex.median()]])
+    return np.nan_to_num(medians, nan=0).astype(np.float32), names + cov_names + ['sex']
+
+
+def predict_chunked(args, xgb_model, enet_model, out_file):
+    """Predicts chunk_size samples at a time and appends each chunk to the output, so memory is bounded by the
+    chunk rather than the cohort"""
+    xgb_path, enet_path = f"{args.ext_feature}_xgb.npy", f"{args.ext_feature}_enet.npy"
+    other_scores = load_other_scores(args)
+    fill, full_names = enet_fill_values(args, enet_path)
+    enet_model = for_columns(enet_model, full_names)
+
+    xgb_chunks = utils.iter_data_chunks(xgb_path, args.ext_cov, f"{args.train_names}_xgb.names", args.ext_label, args.chunk_size)
+    enet_chunks = utils.iter_data_chunks(enet_path, args.ext_cov, f"{args.train_names}_enet.names", args.ext_label, args.chunk_size)
+    n_done = 0
+    for (X_xgb, y_chunk, xgb_names, identifiers), (X_enet, _, _, _) in zip(xgb_chunks, enet_chunks):
+        if n_done == 0:
+            xgb_model = for_columns(xgb_model, xgb_names)
+        xgb_probs = xgb_model.predict_proba(X_xgb)[:, 1]
+        X_enet_np = X_enet.to_numpy()
+        X_enet_np = np.where(np.isnan(X_enet_np), fill, X_enet_np)
+        enet_probs = enet_model.predict_proba(X_enet_np)[:, 1]
+        del X_xgb, X_enet, X_enet_np
+
+        results = identifiers.copy()
+        results.columns = ['FID', 'IID']
+        results['True_Label'] = y_chunk.values
+        results['BD_mitoPRS_XGB'] = xgb_probs
+        results['BD_mitoPRS_ENet'] = enet_probs
+        results = merge_other_scores(results, other_scores)
+        results.to_csv(out_file, index=False, mode='w' if n_done == 0 else 'a', header=n_done == 0)
+        n_done += len(results)
+        print(f">>> {n_done} samples scored (peak memory {utils.peak_memory_gb():.2f} GB)")
     
 if __name__ == "__main__":
     main()
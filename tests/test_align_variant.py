@@ -0,0 +1,38 @@
+import os
+
+import pandas as pd
+
+import align_variant
+from align_variant import harmonize, load_panel_index
+
+
+def write_bim(path, rows):
+    pd.DataFrame(rows).to_csv(path, sep='\t', index=False, header=False)
+
+
+def test_chromosome_names_match_exactly(tmp_path):
+    write_bim(tmp_path / 'ref.bim', [('1', 'rs1', 0, 100, 'A', 'C'), ('X', 'rs2', 0, 200, 'A', 'G'),
+                                     ('MT', 'rs3', 0, 300, 'C', 'T'), ('2', 'rs4', 0, 400, 'G', 'T')])
+    tgt = pd.DataFrame([('chr1', 'v1', 0, 100, 'A', 'C'), ('23', 'v2', 0, 200, 'A', 'G'),
+                        ('M', 'v3', 0, 300, 'C', 'T'), ('02', 'v4', 0, 400, 'G', 'T'),
+                        ('CHRX', 'v5', 0, 200, 'A', 'G')], columns=align_variant.TGT_COLUMNS)
+    keep, _, _ = harmonize(load_panel_index(str(tmp_path / 'ref')), tgt)
+    assert keep.to_dict() == {'v1': 'rs1', 'v5': 'rs2'}
+
+
+def test_compiled_panel_is_reused_until_bim_changes(tmp_path, monkeypatch):
+    ref_pref = str(tmp_path / 'ref')
+    write_bim(tmp_path / 'ref.bim', [('1', 'rs1', 0, 100, 'A', 'C'), ('1', 'rs2', 0, 50, 'A', 'G')])
+    first = load_panel_index(ref_pref)
+
+    def no_read(*args):
+        raise AssertionError("reference .bim was read")
+    monkeypatch.setattr(align_variant, 'read_bim', no_read)
+    panel = load_panel_index(ref_pref)
+    assert list(panel.ids) == ['rs1', 'rs2'] and list(panel.allele_strings('a2')) == ['C', 'G']
+    assert list(panel.index['row']) == list(first.index['row']) == [1, 0]
+
+    write_bim(tmp_path / 'ref.bim', [('1', 'rs3', 0, 100, 'A', 'C')])
+    os.utime(tmp_path / 'ref.bim', ns=(0, 12345))
+    monkeypatch.undo()
+    assert list(load_panel_index(ref_pref).ids) == ['rs3']
@@ -0,0 +1,75 @@
+import warnings
+
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+
+from mitoprs_utils import InformedElasticNet
+
+
+def make_data(n=400, p=60, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.integers(0, 3, (n, p)).astype(np.float32)
+    w = np.zeros(p)
+    w[:5] = 0.8
+    y = (rng.random(n) < 1 / (1 + np.exp(-(X - 1) @ w))).astype(np.float64)
+    return X, y
+
+
+def lambda_max(X, y, l1_ratio):
+    # Smallest 1/C at which every coefficient is zero, from the gradient at the intercept-only model
+    return np.abs(X.T @ (y - y.mean())).max() / l1_ratio
+
+
+def test_path_starting_above_lambda_max():
+    X, y = make_data()
+    l1_ratio = 0.5
+    c_max = 1 / lambda_max(X, y, l1_ratio)
+    Cs = np.array([c_max / 100, c_max / 10, c_max * 20])
+    model = InformedElasticNet(tol=1e-6, max_iter=10000)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        path = list(model._path(X, y, np.arange(len(y)), Cs, l1_ratio))
+
+    for C, coef, intercept in path[:2]:
+        assert not coef.any()
+        assert np.isclose(intercept, np.log(y.mean() / (1 - y.mean())))
+
+    # Past lambda_max the KKT check brings variants back, matching an unscreened fit
+    C, coef, intercept = path[2]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        direct = LogisticRegression(penalty='elasticnet', solver='saga', C=C, l1_ratio=l1_ratio,
+                                    tol=1e-6, max_iter=10000).fit(X, y)
+    assert coef.any()
+    np.testing.assert_allclose(coef, direct.coef_[0], atol=1e-3)
+    np.testing.assert_allclose(intercept, direct.intercept_[0], atol=1e-3)
+
+
+def test_fit_path_without_betas():
+    X, y = make_data()
+    c_max = 1 / lambda_max(X, y, 0.5)
+    model = InformedElasticNet()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        model.fit_path(X, y, np.logspace(np.log10(c_max / 100), np.log10(c_max * 100), 5), [0.5], cv=3)
+    assert model.coef_.shape == (1, X.shape[1])
+    assert model.predict_proba(X).shape == (len(y), 2)
+
+
+def test_betas_only_warm_start_the_screened_first_fit(monkeypatch):
+    X, y = make_data()
+    l1_ratio = 0.5
+    C = 1.25 / lambda_max(X, y, l1_ratio)
+    betas = np.random.default_rng(1).normal(0, 0.1, (1, X.shape[1]))
+    widths = []
+    fit = LogisticRegression.fit
+    monkeypatch.setattr(LogisticRegression, 'fit', lambda self, X, y: widths.append(X.shape[1]) or fit(self, X, y))
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        informed = list(InformedElasticNet(tol=1e-6, max_iter=10000, betas=betas)._path(X, y, np.arange(len(y)), [C], l1_ratio))
+        plain = list(InformedElasticNet(tol=1e-6, max_iter=10000)._path(X, y, np.arange(len(y)), [C], l1_ratio))
+
+    # Dense betas do not widen the first fit beyond the screened columns
+    assert widths[0] < X.shape[1]
+    np.testing.assert_allclose(informed[0][1], plain[0][1], atol=1e-3)
@@ -0,0 +1,17 @@
+import numpy as np
+import pytest
+
+from FRAPOSA.fraposa import svd_eigcov, svd_eigcov_topk
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_topk_matches_dense(seed):
+    rng = np.random.default_rng(seed)
+    X = rng.standard_normal((300, 60))
+    XTX = X.T @ X
+    k = 8
+    s, V = svd_eigcov(XTX)
+    s_k, V_k = svd_eigcov_topk(XTX, k)
+    np.testing.assert_allclose(s_k, s[:k], rtol=1e-10)
+    np.testing.assert_allclose(V_k, V[:, :k], atol=1e-8)
+    assert (V_k[np.argmax(np.abs(V_k), axis=0), np.arange(k)] > 0).all()
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from sklearn.linear_model import LogisticRegression
+
+from model_artifacts import ENetScorer, XGBScorer, prune_booster
+
+
+def make_data(n=300, n_variants=40, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.integers(0, 3, (n, n_variants + 2)).astype(np.float32)
+    X[rng.random(X.shape) < 0.05] = np.nan
+    names = [f"rs{i}_A" for i in range(n_variants)] + ['Covariate1', 'sex']
+    y = (np.nan_to_num(X[:, 0]) + np.nan_to_num(X[:, 3]) + rng.random(n) > 2.5).astype(int)
+    return pd.DataFrame(X, columns=names), y
+
+
+def test_pruned_xgb_matches_classifier(tmp_path):
+    X, y = make_data()
+    model = xgb.XGBClassifier(n_estimators=200, max_depth=2, early_stopping_rounds=5)
+    model.fit(X[:200], y[:200], eval_set=[(X[200:], y[200:])], verbose=False)
+    booster = model.get_booster()
+    pruned = prune_booster(booster, XGBScorer.iteration_range_of(booster))
+    assert len(pruned.feature_names) < X.shape[1]
+    pruned.save_model(tmp_path / 'xgb.ubj')
+    scorer = XGBScorer(str(tmp_path / 'xgb.ubj'), n_threads=2)
+
+    expected = model.predict_proba(X)
+    # All exported columns, and only the columns the trees split on
+    full = scorer.for_columns(list(X.columns))
+    np.testing.assert_array_equal(full.predict_proba(X), expected)
+    np.testing.assert_array_equal(full.predict_proba(X, block_size=64), expected)
+    used = X[pruned.feature_names]
+    subset = scorer.for_columns(list(used.columns))
+    assert subset.columns is None # Already in the booster's order: no gather
+    np.testing.assert_array_equal(subset.predict_proba(used.to_numpy()), expected)
+
+
+def test_enet_scorer_matches_logistic_regression(tmp_path):
+    X, y = make_data(seed=1)
+    X = X.fillna(0).to_numpy(dtype=np.float64)
+    model = LogisticRegression(penalty='elasticnet', solver='saga', C=0.05, l1_ratio=0.9, max_iter=5000).fit(X, y)
+    varids = np.array([f"rs{i}" for i in range(X.shape[1] - 2)])
+    np.savez(tmp_path / 'enet.npz', coef=model.coef_.ravel(), intercept=model.intercept_[0], varids=varids)
+    scorer = ENetScorer(str(tmp_path / 'enet.npz'))
+    assert 0 < len(scorer.nonzero) < X.shape[1]
+
+    expected = model.predict_proba(X)
+    names = [f"{v}_A" for v in varids] + ['Covariate1', 'sex']
+    np.testing.assert_allclose(scorer.for_columns(names).predict_proba(X), expected, rtol=0, atol=1e-12)
+    # Only the variants with non-zero coefficients, as the pipeline exports them
+    active = np.flatnonzero(model.coef_[0, :len(varids)])
+    cols = np.concatenate([active, [len(varids), len(varids) + 1]])
+    np.testing.assert_allclose(scorer.for_columns([names[i] for i in cols]).predict_proba(X[:, cols]), expected,
+                               rtol=0, atol=1e-12)
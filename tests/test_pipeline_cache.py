@@ -0,0 +1,23 @@
+import os
+import time
+
+from mitoprs_pipeline import Stage, StageCache
+
+
+def test_prune_removes_entries_unused_since_cutoff(tmp_path):
+    cache = StageCache(str(tmp_path / 'cache'))
+    stage = Stage("features", "true", outputs=["${work}/out.txt"])
+    variables = {'work': str(tmp_path)}
+    (tmp_path / 'out.txt').write_text('x')
+    for key in ['old', 'used', 'new']:
+        cache.store(stage, key, variables)
+
+    run_start = time.time()
+    week_ago = run_start - 7 * 86400
+    for key in ['old', 'used']:
+        os.utime(tmp_path / 'cache' / 'features' / key, (week_ago, week_ago))
+    cache.restore(stage, 'used', variables)
+
+    cache.prune(1, run_start)
+    assert sorted(os.listdir(tmp_path / 'cache' / 'features')) == ['new', 'used']
+    assert (tmp_path / 'out.txt').read_text() == 'x'
@@ -0,0 +1,56 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import xgboost as xgb
+
+import score_mitoprs
+from model_artifacts import ENET_PATH, XGB_PATH, artifact_paths
+
+
+def write_run(tmp_path, n=120, n_xgb=30, n_enet=50, seed=0):
+    """Feature matrices as feature_matrix.py writes them, covariates, labels, other scores and exported models"""
+    rng = np.random.default_rng(seed)
+    fam = pd.DataFrame({'FID': [f"F{i}" for i in range(n)], 'IID': [f"I{i}" for i in range(n)]})
+    labels = fam.assign(PAT=0, MAT=0, SEX=rng.integers(1, 3, n), PHENO=rng.integers(1, 3, n))
+    labels.to_csv(tmp_path / 'o.pheno', sep='\t', header=False, index=False)
+    cov = fam.assign(**{f"PC{k}": rng.normal(size=n) for k in range(1, 6)})
+    cov.to_csv(tmp_path / 't.oadp', sep='\t', index=False)
+    fam.assign(SCORE=rng.normal(size=n)).to_csv(tmp_path / 'X.csx.profile', sep=' ', index=False)
+    fam.assign(**{'Pt_0.25': rng.normal(size=n)}).to_csv(tmp_path / 'X.all_score', sep=' ', index=False)
+
+    other = [f"Covariate{k}" for k in range(1, 6)] + ['sex']
+    for model, n_variants in [('xgb', n_xgb), ('enet', n_enet)]:
+        counts = rng.integers(-1, 3, (n, n_variants)).astype(np.int8)
+        np.save(tmp_path / f"o_{model}.npy", counts)
+        (tmp_path / f"o_{model}.names").write_text('\t'.join(f"rs{i}_A" for i in range(n_variants)) + '\n')
+
+    os.makedirs(tmp_path / 'model')
+    xgb_art, enet_art = (tmp_path / p for p in artifact_paths(XGB_PATH, ENET_PATH))
+    names = [f"rs{i}_A" for i in range(n_xgb)] + other
+    X = pd.DataFrame(rng.integers(0, 3, (200, len(names))).astype(np.float32), columns=names)
+    xgb.XGBClassifier(n_estimators=20, max_depth=3).fit(X, rng.integers(0, 2, 200)).get_booster().save_model(xgb_art)
+    coef = rng.normal(size=n_enet + len(other)) * (rng.random(n_enet + len(other)) < 0.5)
+    np.savez(enet_art, coef=coef, intercept=np.float64(-0.3), varids=np.array([f"rs{i}" for i in range(n_enet)]))
+
+
+def score(tmp_path, monkeypatch, out_prefix, *extra):
+    monkeypatch.setattr(sys, 'argv', ['score_mitoprs.py', '--ext-feature', 'o', '--ext-cov', 't.oadp',
+                                      '--ext-label', 'o.pheno', '--train-names', 'o', '--work-dir', '.',
+                                      '--out-prefix', out_prefix, *extra])
+    score_mitoprs.main()
+    return pd.read_csv(tmp_path / 'output' / f"{out_prefix}_predictions.csv")
+
+
+@pytest.mark.parametrize('chunk_size', [7, 1000])
+def test_chunked_matches_in_memory(tmp_path, monkeypatch, chunk_size):
+    write_run(tmp_path)
+    monkeypatch.chdir(tmp_path)
+    full = score(tmp_path, monkeypatch, 'X')
+    chunked = score(tmp_path, monkeypatch, 'X', '--chunk-size', str(chunk_size))
+
+    pd.testing.assert_frame_equal(chunked.drop(columns='BD_mitoPRS_ENet'), full.drop(columns='BD_mitoPRS_ENet'))
+    # float32 dot products may round differently with the number of rows
+    np.testing.assert_allclose(chunked['BD_mitoPRS_ENet'], full['BD_mitoPRS_ENet'], rtol=0, atol=1e-6)
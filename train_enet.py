@@ -0,0 +1,59 @@
+import argparse
+
+import joblib
+import numpy as np
+import pandas as pd
+
+import mitoprs_utils as utils
+
+
+def impute_medians(X, block_size=4096):
+    """Fills missing values with their column medians (0 where a column has none) in place, as score_mitoprs.py
+    does before the ENet predicts"""
+    for start in range(0, X.shape[1], block_size):
+        block = X[:, start:start + block_size]
+        missing = np.isnan(block)
+        if missing.any():
+            medians = np.nan_to_num(np.nanmedian(block, axis=0), nan=0)
+            block[missing] = np.broadcast_to(medians, block.shape)[missing]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Trains the beta-informed ENet over a path of penalties, choosing "
+                                                 "C and l1_ratio by cross-validated AUC")
+    parser.add_argument('--feature', required=True, help='Genotype matrix (.npy from feature_matrix.py)')
+    parser.add_argument('--cov', required=True)
+    parser.add_argument('--label', required=True)
+    parser.add_argument('--names', required=True)
+    parser.add_argument('--betas', default=None,
+                        help='Tab-delimited feature name and initial coefficient per line; features not listed start at 0')
+    parser.add_argument('--Cs', default='0.0001,0.1,20', help='Smallest C, largest C and number of log-spaced values')
+    parser.add_argument('--l1-ratios', default='0.1,0.5,0.9', help='Comma-separated l1_ratio values')
+    parser.add_argument('--cv', type=int, default=5)
+    parser.add_argument('--tol', type=float, default=0.01)
+    parser.add_argument('--out', required=True, help='Model written to <out>.pkl, validation AUCs to <out>.path_scores.tsv')
+    args = parser.parse_args()
+
+    X_main, feature_names, cov, cov_names, sex, y, _ = utils.read_split_parts(args.feature, args.cov, args.names, args.label)
+    X = utils.assemble_features(X_main, cov, sex)
+    full_names = feature_names + cov_names + ['sex']
+    del X_main
+    impute_medians(X)
+    betas = None
+    if args.betas:
+        betas = pd.read_csv(args.betas, sep='\t', header=None, index_col=0).iloc[:, 0]
+        betas = betas.reindex(full_names).fillna(0).to_numpy(dtype=np.float64)[np.newaxis, :]
+
+    c_min, c_max, n_c = args.Cs.split(',')
+    Cs = np.logspace(np.log10(float(c_min)), np.log10(float(c_max)), int(n_c))
+    model = utils.InformedElasticNet(tol=args.tol, betas=betas)
+    model.fit_path(X, y, Cs, [float(r) for r in args.l1_ratios.split(',')], cv=args.cv)
+    print(f"{np.count_nonzero(model.coef_)} of {X.shape[1]} coefficients are non-zero")
+
+    joblib.dump(model, f"{args.out}.pkl")
+    model.path_scores_.to_csv(f"{args.out}.path_scores.tsv", sep='\t')
+    print(f"Model written to {args.out}.pkl")
+
+
+if __name__ == "__main__":
+    main()